@@ -0,0 +1,276 @@
+"""
+Handler benchmarks against a synthetic user base.
+
+Populates a throwaway vpn_bot.db with N users (one key each), puts the fake `awg`/`ip`
+binaries from benchmarks/fake_bin first in PATH (every call is recorded) and drives the
+real handlers through Dispatcher.feed_update with a mocked Bot session, the same way
+aiogram's own test suite does. Nothing talks to Telegram or touches the real database.
+
+Usage:
+    python -m benchmarks.bench_handlers                       # 1k, 10k and 100k users
+    python -m benchmarks.bench_handlers --users 1000 --iterations 50
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_BIN = os.path.join(ROOT, "benchmarks", "fake_bin")
+BASE_TELEGRAM_ID = 10_000_000
+
+def subnet_for(users: int) -> str:
+    # Room for every synthetic key plus the devices added during the run
+    prefix = 32 - max(8, (users * 2).bit_length())
+    return f"10.0.0.0/{prefix}"
+
+def configure_environment(workdir: str, max_users: int):
+    """Must run before anything from src/ or config is imported."""
+    sys.path.insert(0, ROOT)
+    os.environ["PATH"] = FAKE_BIN + os.pathsep + os.environ.get("PATH", "")
+    os.environ["FAKE_BIN_LOG"] = os.path.join(workdir, "fake_bin.log")
+    # Explicit values win over .env, so a production DB_NAME is never used
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "PAYMENT_TOKEN": "benchmark",
+        "ADMIN_IDS": "1",
+        "DB_NAME": os.path.join(workdir, "vpn_bot.db"),
+        "VPN_HOST": "127.0.0.1",
+        "VPN_SUBNET": subnet_for(max_users),
+        "METRICS_PORT": "0",
+        "AMNEZIA_JC": "4", "AMNEZIA_JMIN": "50", "AMNEZIA_JMAX": "1000",
+        "AMNEZIA_S1": "15", "AMNEZIA_S2": "25",
+        "AMNEZIA_H1": "1", "AMNEZIA_H2": "2", "AMNEZIA_H3": "3", "AMNEZIA_H4": "4",
+    })
+
+def fake_bin_calls() -> int:
+    try:
+        with open(os.environ["FAKE_BIN_LOG"]) as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message, User
+
+    def fake_result(method):
+        returning = method.__returning__
+        options = typing.get_args(returning) or (returning,)
+        if Message in options:
+            chat_id = getattr(method, "chat_id", None) or 1
+            return Message(message_id=1, date=datetime.datetime.now(), chat=Chat(id=chat_id, type="private"), text="ok")
+        if User in options:
+            return User(id=1, is_bot=True, first_name="Benchmark", username="benchmark_bot")
+        if bool in options:
+            return True
+        return None
+
+    class MockedSession(BaseSession):
+        """Answers every Bot API call locally and counts them."""
+
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            return fake_result(method)
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return MockedSession
+
+async def populate(db_path: str, users: int, expired_ratio: float) -> list:
+    """Creates users with one active key each. Returns telegram_ids with an active subscription."""
+    from config import settings
+    from src import database
+    from src.catalog import load_catalog
+    from src.vpn_service import vpn_service
+
+    settings.DB_NAME = db_path
+    await database.init_db()
+    await load_catalog()
+
+    now = datetime.datetime.now()
+    active_end = (now + datetime.timedelta(days=30)).isoformat()
+    expired_end = (now - datetime.timedelta(hours=1)).isoformat()
+    expired = set(random.sample(range(users), int(users * expired_ratio)))
+
+    server_pub = vpn_service.get_server_pubkey()
+    hosts = vpn_service.subnet.hosts()
+    next(hosts)  # server address
+
+    user_rows = []
+    key_rows = []
+    for i in range(users):
+        end = expired_end if i in expired else active_end
+        user_rows.append((BASE_TELEGRAM_ID + i, f"user{i}", end, 1_000_000))
+        ip = str(next(hosts))
+        private_key = f"{i:043d}="
+        config = vpn_service.generate_client_config(private_key, ip, server_pub)
+        key_rows.append((i + 1, f"P{i:042d}=", private_key, ip, config, "Device 1"))
+
+    with sqlite3.connect(db_path) as db:
+        db.executemany(
+            "INSERT INTO users (telegram_id, username, subscription_end_date, max_devices) VALUES (?, ?, ?, ?)",
+            user_rows
+        )
+        db.executemany(
+            "INSERT INTO keys (user_id, public_key, private_key, ip_address, config, device_name) VALUES (?, ?, ?, ?, ?, ?)",
+            key_rows
+        )
+    return [BASE_TELEGRAM_ID + i for i in range(users) if i not in expired]
+
+def user_json(telegram_id: int) -> dict:
+    return {"id": telegram_id, "is_bot": False, "first_name": "Bench", "username": f"user{telegram_id}"}
+
+def message_json(telegram_id: int, **fields) -> dict:
+    return {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": telegram_id, "type": "private"},
+        "from": user_json(telegram_id),
+        **fields,
+    }
+
+def callback_update(update_id: int, telegram_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_json(telegram_id),
+            "chat_instance": "benchmark",
+            "data": data,
+            "message": message_json(telegram_id, text="menu"),
+        },
+    }
+
+def payment_update(update_id: int, telegram_id: int, payload: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": message_json(telegram_id, successful_payment={
+            "currency": "RUB",
+            "total_amount": 10000,
+            "invoice_payload": payload,
+            "telegram_payment_charge_id": f"tg_{update_id}",
+            "provider_payment_charge_id": f"pr_{update_id}",
+        }),
+    }
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+class Report:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, users: int, scenario: str, samples: list, errors: int, calls: int):
+        samples = sorted(samples)
+        total = sum(samples)
+        self.rows.append((
+            users, scenario, len(samples),
+            len(samples) / total if total else 0.0,
+            percentile(samples, 0.50) * 1000,
+            percentile(samples, 0.99) * 1000,
+            calls / len(samples),
+            errors,
+        ))
+        print(self.format_row(self.rows[-1]), flush=True)
+
+    @staticmethod
+    def header() -> str:
+        return f"{'users':>7}  {'scenario':<28} {'iters':>6} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'awg/op':>7} {'errors':>6}"
+
+    @staticmethod
+    def format_row(row) -> str:
+        users, scenario, iters, ops, p50, p99, calls, errors = row
+        return f"{users:>7}  {scenario:<28} {iters:>6} {ops:>9.1f} {p50:>9.2f} {p99:>9.2f} {calls:>7.2f} {errors:>6}"
+
+async def run_scale(dp, bot, users: int, iterations: int, expired_ratio: float, workdir: str, report: Report):
+    from aiogram.types import Update
+    from src.scheduler import check_expired_subscriptions
+
+    db_path = os.path.join(workdir, f"vpn_bot_{users}.db")
+    active_ids = await populate(db_path, users, expired_ratio)
+    update_ids = iter(range(1, 10**9))
+
+    async def drive(scenario: str, make_update):
+        samples = []
+        errors = 0
+        calls_before = fake_bin_calls()
+        for _ in range(iterations):
+            telegram_id = random.choice(active_ids)
+            raw = make_update(next(update_ids), telegram_id)
+            update = Update.model_validate(raw, context={"bot": bot})
+            start = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors += 1
+                logging.debug(f"{scenario} failed: {e}")
+            samples.append(time.perf_counter() - start)
+        report.add(users, scenario, samples, errors, fake_bin_calls() - calls_before)
+
+    def key_id(telegram_id: int) -> int:
+        # Synthetic users own exactly one key with id == users.id
+        return telegram_id - BASE_TELEGRAM_ID + 1
+
+    await drive("profile", lambda u, t: callback_update(u, t, "profile"))
+    await drive("key_qr", lambda u, t: callback_update(u, t, f"key_qr_{key_id(t)}"))
+    await drive("key_amnezia_app", lambda u, t: callback_update(u, t, f"key_amnezia_app_{key_id(t)}"))
+    await drive("add_device", lambda u, t: callback_update(u, t, "add_device"))
+    await drive("successful_payment", lambda u, t: payment_update(u, t, "sub_30"))
+
+    calls_before = fake_bin_calls()
+    start = time.perf_counter()
+    await check_expired_subscriptions(bot)
+    elapsed = time.perf_counter() - start
+    report.add(users, f"check_expired ({users - len(active_ids)} expired)", [elapsed], 0, fake_bin_calls() - calls_before)
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="vpn_bench_")
+    configure_environment(workdir, max(args.users))
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    from aiogram import Bot
+    from src.audit import audit_log
+    from src.bot import create_dispatcher
+
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=make_session_class()())
+    dp = create_dispatcher()
+    report = Report()
+    print(Report.header(), flush=True)
+    audit_log.start()
+    try:
+        for users in args.users:
+            await run_scale(dp, bot, users, args.iterations, args.expired_ratio, workdir, report)
+    finally:
+        await audit_log.stop()
+        await bot.session.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Benchmark data kept in {workdir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against a synthetic user base")
+    parser.add_argument("--users", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--iterations", type=int, default=100, help="updates per scenario and scale")
+    parser.add_argument("--expired-ratio", type=float, default=0.002, help="share of users expired before check_expired")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary databases and call log")
+    asyncio.run(main(parser.parse_args()))
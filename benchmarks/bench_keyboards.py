@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of keyboards.py: per-call cost of building a markup (the way every call
+worked before) against the cached accessors handlers use now.
+
+Usage:
+    python -m benchmarks.bench_keyboards
+    python -m benchmarks.bench_keyboards --number 20000 --devices 5000
+"""
+import argparse
+import random
+import tempfile
+import timeit
+
+from benchmarks.bench_handlers import configure_environment
+
+def per_call_us(fn, number: int) -> float:
+    # Best of 5 runs, in microseconds per call
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def main(args):
+    configure_environment(tempfile.mkdtemp(prefix="vpn_bench_"), 1000)
+    random.seed(args.seed)
+
+    from src import keyboards
+    from src.catalog import get_catalog
+
+    catalog = get_catalog()
+    devices = [{"id": 1, "device_name": "Device 1"}, {"id": 2, "device_name": "Device 2"}]
+    device_tuples = tuple((d["id"], d["device_name"]) for d in devices)
+    # Callback traffic: random devices out of a working set that fits the LRU
+    device_ids = [random.randrange(args.devices) for _ in range(args.number)]
+
+    def ids():
+        while True:
+            yield from device_ids
+    built_ids, cached_ids = ids(), ids()
+
+    cases = [
+        ("main_menu_kb", keyboards._build_main_menu_kb, keyboards.main_menu_kb),
+        ("buy_sub_kb", lambda: keyboards._build_buy_sub_kb(catalog), keyboards.buy_sub_kb),
+        ("profile_kb", lambda: keyboards._build_profile_kb(True), lambda: keyboards.profile_kb(True)),
+        ("devices_kb", lambda: keyboards._build_devices_kb(device_tuples, True), lambda: keyboards.devices_kb(devices, True)),
+        (f"device_actions_kb ({args.devices} ids)",
+         lambda: keyboards._build_device_actions_kb(next(built_ids)),
+         lambda: keyboards.device_actions_kb(next(cached_ids))),
+        ("back_kb", keyboards._build_back_kb, keyboards.back_kb),
+        ("admin_kb", keyboards._build_admin_kb, keyboards.admin_kb),
+    ]
+
+    print(f"{'keyboard':<32} {'built us':>9} {'cached us':>10} {'speedup':>8}")
+    for name, build, cached in cases:
+        cached()  # warm up
+        before = per_call_us(build, args.number)
+        after = per_call_us(cached, args.number)
+        print(f"{name:<32} {before:>9.2f} {after:>10.3f} {before / after:>7.0f}x")
+    info = keyboards._cached_device_actions_kb.cache_info()
+    print(f"device_actions_kb LRU: {info.hits} hits, {info.misses} misses, size {info.currsize}/{info.maxsize}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-call cost of building vs cached inline keyboards")
+    parser.add_argument("--number", type=int, default=10_000, help="calls per timing run")
+    parser.add_argument("--devices", type=int, default=1_000, help="distinct device ids for device_actions_kb")
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
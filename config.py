@@ -1,4 +1,6 @@
 from pydantic_settings import BaseSettings
+from contextlib import contextmanager
+from contextvars import ContextVar
 from typing import List
 
 class Settings(BaseSettings):
@@ -12,7 +14,25 @@ class Settings(BaseSettings):
     VPN_HOST: str
     VPN_PORT: int = 51821
     VPN_SUBNET: str = "10.9.0.0/24"
+    VPN_SUBNET_V6: str = ""  # IPv6 ULA prefix for dual-stack, e.g. fd09::/64; empty disables IPv6
+    # Several interfaces on one host: "iface,port,subnet[,ipv6 prefix];..." (empty = single interface above)
+    VPN_SHARDS: str = ""
+    VPN_SHARD_STRATEGY: str = "least_loaded"  # least_loaded | hash
     VPN_DNS: str = "8.8.8.8"
+    # Per-peer download shaping (tc/HTB) by plan: "sub_30=20mbit,sub_90=50mbit,sub_365=100mbit,default=20mbit"; empty disables
+    SHAPING_RATES: str = ""
+    SHAPING_LINK_RATE: str = "1gbit"
+    # awg calls: timeout, and a circuit breaker that fails fast after N consecutive failures
+    VPN_COMMAND_TIMEOUT: int = 15  # seconds
+    VPN_BREAKER_FAILURES: int = 5
+    VPN_BREAKER_RESET_SECONDS: int = 30
+    # Provisioning jobs retried with exponential backoff while the interface is down
+    JOB_WORKERS: int = 2
+    JOB_MAX_ATTEMPTS: int = 10
+    JOB_BACKOFF_SECONDS: int = 5
+    JOB_BACKOFF_MAX_SECONDS: int = 3600
+    # Periodic DB <-> interface reconciliation, 0 disables
+    RECONCILE_INTERVAL_MINUTES: int = 30
     
     # Obfuscation
     AMNEZIA_JC: int
@@ -29,10 +49,50 @@ class Settings(BaseSettings):
     PRICE_1_MONTH: int = 100
     PRICE_3_MONTHS: int = 400
     PRICE_12_MONTHS: int = 1500
+    PRICE_SLOT: int = 100
+    # The values above only seed the products table on first start; later changes go through /set_price
     
     # Referral Settings
     REF_REWARD_THRESHOLD: int = 3
     REF_REWARD_DAYS: int = 30
+    # Multi-level rewards: days per paying referee at levels 2, 3, ... e.g. "7,3"; empty = direct referrals only
+    REF_LEVEL_REWARD_DAYS: str = ""
+
+    # Rate limiting of inline buttons, per user (token bucket)
+    RATE_LIMIT_PER_SECOND: float = 2.0
+    RATE_LIMIT_BURST: int = 10
+
+    # Pre-expiry reminders: offsets before subscription_end_date (s/m/h/d), empty disables
+    REMINDER_OFFSETS: str = "3d,1d,1h"
+    REMINDER_INTERVAL_MINUTES: int = 10
+    NOTIFY_RATE_PER_SECOND: float = 25.0  # Telegram allows about 30 messages per second per bot
+
+    # Audit log: buffered events are written every AUDIT_FLUSH_EVENTS events or AUDIT_FLUSH_INTERVAL_MS
+    AUDIT_FLUSH_EVENTS: int = 100
+    AUDIT_FLUSH_INTERVAL_MS: int = 500
+
+    # Online backups of DB_NAME: gzip snapshots in BACKUP_DIR, BACKUP_INTERVAL_HOURS=0 disables the schedule
+    BACKUP_DIR: str = "backups"
+    BACKUP_KEEP: int = 7
+    BACKUP_INTERVAL_HOURS: int = 24
+    BACKUP_STEP_PAGES: int = 1000  # pages copied per step, the DB is unlocked between steps
+
+    # Restarts: keep updates queued during a deploy and drain in-flight work on SIGTERM
+    DROP_PENDING_UPDATES: bool = False
+    FSM_STORAGE: str = "sqlite"  # sqlite | memory | redis://...
+    SHUTDOWN_TIMEOUT: int = 30  # seconds
+
+    # Log the stack of code that blocks the event loop longer than this, 0 disables the monitor
+    LOOP_LAG_THRESHOLD_MS: int = 200
+
+    # Multi-tenant mode: JSON file with more bots (brands) to host in this process, see src/tenants.py.
+    # TENANT names the brand whose settings are in effect; the .env one is "default"
+    TENANTS_FILE: str = ""
+    TENANT: str = "default"
+
+    # Metrics endpoint (Prometheus text format), METRICS_PORT=0 disables it
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9464
 
     class Config:
         env_file = ".env"
@@ -45,4 +105,52 @@ class Settings(BaseSettings):
             return [int(x.strip()) for x in self.ADMIN_IDS.split(',')]
         return self.ADMIN_IDS
 
-settings = Settings()
+    @property
+    def reminder_offsets(self) -> List[int]:
+        # Seconds, ascending
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+        offsets = set()
+        for item in self.REMINDER_OFFSETS.split(","):
+            item = item.strip().lower()
+            if item:
+                offsets.add(int(item[:-1]) * units[item[-1]] if item[-1] in units else int(item))
+        return sorted(offsets)
+
+    @property
+    def referral_levels(self) -> List[tuple]:
+        # (level, threshold, days): every `threshold` paying referees at `level` give `days`
+        levels = [(1, self.REF_REWARD_THRESHOLD, self.REF_REWARD_DAYS)]
+        extra = [int(x) for x in self.REF_LEVEL_REWARD_DAYS.split(",") if x.strip()]
+        levels += [(level, 1, days) for level, days in enumerate(extra, start=2)]
+        return levels
+
+class CurrentSettings:
+    """
+    `settings` as imported everywhere: the Settings of the tenant being served (set per update,
+    job and background task by src/tenants.py), the .env ones outside of any tenant.
+    """
+
+    def __init__(self, default: Settings):
+        object.__setattr__(self, "_default", default)
+
+    def __getattr__(self, name):
+        current = _current_settings.get()
+        return getattr(self._default if current is None else current, name)
+
+    def __setattr__(self, name, value):
+        current = _current_settings.get()
+        setattr(self._default if current is None else current, name, value)
+
+_current_settings = ContextVar("settings", default=None)
+
+@contextmanager
+def use_settings(tenant_settings: Settings):
+    """Makes `settings` resolve to tenant_settings in this context and in tasks and threads started from it."""
+    token = _current_settings.set(tenant_settings)
+    try:
+        yield tenant_settings
+    finally:
+        _current_settings.reset(token)
+
+base_settings = Settings()
+settings = CurrentSettings(base_settings)
@@ -0,0 +1,178 @@
+from src.database import BULK_BATCH_SIZE, bulk_disable_subscriptions, get_all_used_ips, save_key, save_keys, count_active_keys_by_shard, enqueue_jobs
+from src.database import get_user_keys
+from src.vpn_service import PEER_BATCH_SIZE, vpn_shards, peer_restorer, group_by_shard, peer_addresses
+from config import settings
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# IP allocation and key insert must not interleave within a shard, or two keys get the same address
+_allocation_locks = {}
+
+def _allocation_lock(shard: int) -> asyncio.Lock:
+    # Shard numbers repeat across tenants, their address pools do not
+    key = (settings.TENANT, shard)
+    lock = _allocation_locks.get(key)
+    if lock is None:
+        lock = _allocation_locks[key] = asyncio.Lock()
+    return lock
+
+async def create_key(user, device_name: str = "Device 1") -> str:
+    """
+    Creates a VPN key for the user on the picked shard: generates the key pair,
+    allocates addresses, adds the peer and saves the key. Returns the public key.
+    """
+    shard = vpn_shards.pick(user['telegram_id'], await count_active_keys_by_shard())
+    service = vpn_shards[shard]
+
+    # awg runs in threads so a slow or hung interface does not block the event loop
+    priv, pub = await asyncio.to_thread(service.generate_keys)
+    server_pub = await asyncio.to_thread(service.get_server_pubkey)
+
+    async with _allocation_lock(shard):
+        # Proper IPAM
+        used_ips = await get_all_used_ips(shard)
+        client_ip = service.get_next_ip(used_ips)
+        client_ip6 = service.ipv6_for(client_ip)
+
+        await asyncio.to_thread(service.add_peer, pub, client_ip, client_ip6, user['plan'])
+
+        config_text = service.generate_client_config(priv, client_ip, server_pub, client_ip6)
+        await save_key(user['id'], pub, priv, client_ip, config_text, device_name, client_ip6, shard)
+    return pub
+
+async def create_keys_bulk(users: list, on_progress=None) -> tuple:
+    """
+    Creates one key per user, pushing each shard's peers with bulk awg updates. A failing
+    shard does not stop the others. Returns (provisioned, error): the users whose keys were
+    saved, and the last failure, None if every key was created.
+    """
+    loads = await count_active_keys_by_shard()
+    by_shard = {}
+    for user in users:
+        shard = vpn_shards.pick(user['telegram_id'], loads)
+        loads[shard] = loads.get(shard, 0) + 1
+        by_shard.setdefault(shard, []).append(user)
+
+    provisioned = []
+    error = None
+    for shard, shard_users in by_shard.items():
+        service = vpn_shards[shard]
+        try:
+            server_pub = await asyncio.to_thread(service.get_server_pubkey)
+            async with _allocation_lock(shard):
+                used_ips = await get_all_used_ips(shard)
+                client_ips = service.allocate_ips(used_ips, len(shard_users))
+
+                rows = []
+                peers = []
+                for user, client_ip in zip(shard_users, client_ips):
+                    client_ip6 = service.ipv6_for(client_ip)
+                    priv, pub = await asyncio.to_thread(service.generate_keys)
+                    config_text = service.generate_client_config(priv, client_ip, server_pub, client_ip6)
+                    peers.append((pub, client_ip, client_ip6, user['plan']))
+                    rows.append((user['id'], pub, priv, client_ip, config_text, "Device 1", client_ip6, shard))
+                    if on_progress:
+                        await on_progress(len(provisioned) + len(rows))
+
+                for i in range(0, len(peers), PEER_BATCH_SIZE):
+                    # Saved batch by batch: if a later awg batch fails, every peer already on the
+                    # interface has its key row, so its address is not handed out again
+                    await asyncio.to_thread(service.add_peers, peers[i:i + PEER_BATCH_SIZE])
+                    await save_keys(rows[i:i + PEER_BATCH_SIZE])
+                    provisioned += shard_users[i:i + PEER_BATCH_SIZE]
+        except Exception as e:
+            logger.warning(f"Bulk key creation on {service.interface} failed: {e}")
+            error = e
+    return provisioned, error
+
+async def remove_peers_by_shard(keys: list):
+    """Removes peers (rows with public_key, ip_address and shard) from their interfaces, shards in parallel."""
+    await peer_restorer.discard([key['public_key'] for key in keys])
+    await asyncio.gather(*(
+        asyncio.to_thread(
+            vpn_shards[shard].remove_peers,
+            [key['public_key'] for key in shard_keys], [key['ip_address'] for key in shard_keys]
+        )
+        for shard, shard_keys in group_by_shard(keys).items()
+    ))
+
+async def reshape_user(user):
+    """Moves the user's active keys into the bandwidth class of their current plan (after a purchase)."""
+    if not any(service.shaper for _, service in vpn_shards):
+        return
+    keys = await get_user_keys(user['id'])
+    for shard, shard_keys in group_by_shard(keys).items():
+        shaper = vpn_shards[shard].shaper
+        if shaper:
+            await asyncio.to_thread(shaper.apply, [(*peer_addresses(key), user['plan']) for key in shard_keys])
+
+# Deferred work: when the interface is down the change is queued in vpn_jobs and applied
+# by src.jobs workers with backoff once it is back
+
+async def provision_or_defer(user, reason: str) -> bool:
+    """
+    Creates the user's first key now, or queues a provisioning job if the interface fails.
+    Returns True if the key was created right away.
+    """
+    try:
+        await create_key(user)
+        return True
+    except Exception as e:
+        logger.warning(f"Key creation for {user['telegram_id']} failed, queued for retry ({reason}): {e}")
+        await defer_provisioning([user], reason)
+        return False
+
+async def defer_provisioning(users: list, reason: str):
+    payload = json.dumps({"reason": reason})
+    await enqueue_jobs([("provision", user['telegram_id'], payload) for user in users])
+
+async def defer_peer_removal(keys: list, telegram_id: int = None):
+    jobs = []
+    for shard, shard_keys in group_by_shard(keys).items():
+        public_keys = [key['public_key'] for key in shard_keys]
+        ip_addresses = [key['ip_address'] for key in shard_keys]
+        for i in range(0, len(public_keys), PEER_BATCH_SIZE):
+            payload = {
+                "shard": shard,
+                "public_keys": public_keys[i:i + PEER_BATCH_SIZE],
+                "ip_addresses": ip_addresses[i:i + PEER_BATCH_SIZE],
+            }
+            jobs.append(("deprovision", telegram_id, json.dumps(payload)))
+    await enqueue_jobs(jobs)
+
+async def remove_peers_or_defer(keys: list, telegram_id: int = None) -> bool:
+    """Removes peers now, or queues their removal if the interface fails. Returns True if removed now."""
+    try:
+        await remove_peers_by_shard(keys)
+        return True
+    except Exception as e:
+        logger.warning(f"Removing {len(keys)} peers failed, queued for retry: {e}")
+        await defer_peer_removal(keys, telegram_id)
+        return False
+
+async def revoke_access(telegram_ids: list, reason: str = "disabled", on_progress=None) -> tuple:
+    """
+    Immediately cuts users off: ends their subscriptions, deactivates all their keys
+    (one transaction per batch) and removes the peers from the interfaces in bulk.
+    Used by /disable_sub and /bulk_disable_sub, reusable for bans and chargebacks.
+
+    on_progress is an optional coroutine function called with the number of processed users.
+    Returns (revoked public keys, removed): removed is False if the interface update
+    failed and the removal was queued instead.
+    """
+    keys = []
+    for i in range(0, len(telegram_ids), BULK_BATCH_SIZE):
+        batch = telegram_ids[i:i + BULK_BATCH_SIZE]
+        keys += await bulk_disable_subscriptions(batch)
+        if on_progress:
+            await on_progress(i + len(batch))
+
+    removed = True
+    if keys:
+        removed = await remove_peers_or_defer(keys, telegram_ids[0] if len(telegram_ids) == 1 else None)
+
+    logger.info(f"Revoked access for {len(telegram_ids)} users ({reason}), {len(keys)} keys" + ("" if removed else ", removal queued"))
+    return [key['public_key'] for key in keys], removed
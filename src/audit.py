@@ -0,0 +1,82 @@
+"""
+Append-only audit log. Handlers call audit_log.log(...), which only appends to an
+in-memory buffer. A background task writes the buffer to the audit_log table in one
+transaction every AUDIT_FLUSH_EVENTS events or AUDIT_FLUSH_INTERVAL_MS, whichever
+comes first, so request handlers never wait for the disk.
+"""
+from src.database import save_audit_events
+from src.tenants import TenantLocal
+from config import settings
+import asyncio
+import datetime
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_BUFFER = 100_000  # events kept in memory while the DB is unavailable
+
+class AuditWriter:
+    def __init__(self, flush_events: int = None, flush_interval_ms: int = None):
+        self.flush_events = flush_events or settings.AUDIT_FLUSH_EVENTS
+        self.flush_interval = (flush_interval_ms or settings.AUDIT_FLUSH_INTERVAL_MS) / 1000
+        self.buffer = []
+        self.task = None
+        self._wakeup = None
+        self._flush_lock = None
+        self._stopping = False
+
+    def log(self, event: str, telegram_id: int = None, actor_id: int = None, **details):
+        """Records an event. Never blocks, safe to call from any handler."""
+        self.buffer.append((
+            datetime.datetime.now().isoformat(),
+            event,
+            telegram_id,
+            actor_id,
+            json.dumps(details, ensure_ascii=False, default=str) if details else None,
+        ))
+        if len(self.buffer) > MAX_BUFFER:
+            del self.buffer[:len(self.buffer) - MAX_BUFFER]
+            logger.error("Audit buffer overflow, oldest events dropped")
+        if len(self.buffer) >= self.flush_events and self._wakeup:
+            self._wakeup.set()
+
+    def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Writes buffered events. On failure they stay buffered for the next attempt."""
+        if not self.buffer:
+            return 0
+        async with self._flush_lock or asyncio.Lock():
+            rows, self.buffer = self.buffer, []
+            try:
+                await save_audit_events(rows)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} audit events: {e}")
+                self.buffer[:0] = rows
+                return 0
+            return len(rows)
+
+    async def stop(self):
+        # Lets a flush in progress complete instead of cancelling it halfway
+        if self.task:
+            self._stopping = True
+            self._wakeup.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+audit_log = TenantLocal(AuditWriter)
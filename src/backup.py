@@ -0,0 +1,174 @@
+"""
+Online backups of the bot database.
+
+Snapshots are copied with SQLite's backup API, BACKUP_STEP_PAGES pages per step. If the
+database is in WAL mode (the default FSM_STORAGE=sqlite puts the .env bot's database in it),
+the copy reads one pinned snapshot and handlers keep reading and writing while a backup
+runs. In rollback-journal mode the source is only locked during a step, and SQLite restarts
+the copy if another connection wrote in between. Every snapshot is integrity-checked,
+gzip-compressed into BACKUP_DIR and rotated: the BACKUP_KEEP newest are kept.
+"""
+from config import settings
+from src.audit import audit_log
+from src.jobs import job_queue
+from contextlib import closing
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = "vpn_bot-"
+SNAPSHOT_SUFFIX = ".db.gz"
+STEP_SLEEP = 0.01  # seconds between backup steps, lets writers in
+COPY_CHUNK = 1024 * 1024
+REQUIRED_TABLES = ("users", "keys", "transactions")
+
+# One backup or restore at a time
+_lock = asyncio.Lock()
+
+def _integrity_error(path: str):
+    """None if the database passes PRAGMA integrity_check, the reported problems otherwise."""
+    try:
+        with closing(sqlite3.connect(path)) as db:
+            rows = db.execute("PRAGMA integrity_check").fetchall()
+            tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    result = "; ".join(row[0] for row in rows[:5])
+    if result != "ok":
+        return result
+    missing = [table for table in REQUIRED_TABLES if table not in tables]
+    if missing:
+        return f"missing tables: {', '.join(missing)}"
+    return None
+
+def _copy_database(source_path: str, target_path: str, pages: int, pause: float = 0):
+    with closing(sqlite3.connect(source_path)) as source, closing(sqlite3.connect(target_path)) as target:
+        if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            # Pin one snapshot for all steps: in WAL mode a reader does not block writers, and
+            # without it every commit in between would restart the copy, forever under load
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        progress = (lambda status, remaining, total: time.sleep(pause)) if pause else None
+        source.backup(target, pages=pages, progress=progress)
+
+def list_snapshots(backup_dir: str = None) -> list:
+    """Snapshot file paths, newest first."""
+    backup_dir = backup_dir or settings.BACKUP_DIR
+    if not os.path.isdir(backup_dir):
+        return []
+    names = [
+        name for name in os.listdir(backup_dir)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)
+    ]
+    # Timestamped names sort chronologically
+    return [os.path.join(backup_dir, name) for name in sorted(names, reverse=True)]
+
+def rotate_snapshots(backup_dir: str, keep: int, exclude: str = None) -> list:
+    """Removes all but the keep newest snapshots; exclude (a path) is never removed nor counted."""
+    removed = [path for path in list_snapshots(backup_dir) if path != exclude][keep:]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+def create_snapshot(db_path: str = None, backup_dir: str = None, exclude: str = None) -> str:
+    """
+    Takes a compressed snapshot of the live database. Returns its path. Blocking, run in a thread.
+    exclude is a snapshot the rotation must not remove (see rotate_snapshots).
+    """
+    db_path = db_path or settings.DB_NAME
+    backup_dir = backup_dir or settings.BACKUP_DIR
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = f"{datetime.datetime.now():%Y%m%d-%H%M%S}"
+    name = f"{SNAPSHOT_PREFIX}{stamp}{SNAPSHOT_SUFFIX}"
+    n = 1
+    while os.path.exists(os.path.join(backup_dir, name)):
+        # Several snapshots in one second (e.g. /backup right before /restore)
+        name = f"{SNAPSHOT_PREFIX}{stamp}_{n}{SNAPSHOT_SUFFIX}"  # "_" sorts after "."
+        n += 1
+    path = os.path.join(backup_dir, name)
+    raw_path = path + ".tmp"
+    started = time.monotonic()
+    try:
+        _copy_database(db_path, raw_path, settings.BACKUP_STEP_PAGES, STEP_SLEEP)
+        error = _integrity_error(raw_path)
+        if error:
+            raise Exception(f"Snapshot failed integrity check: {error}")
+        with open(raw_path, "rb") as raw, gzip.open(path + ".part", "wb", compresslevel=6) as packed:
+            shutil.copyfileobj(raw, packed, COPY_CHUNK)
+        os.replace(path + ".part", path)
+    finally:
+        for leftover in (raw_path, path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    removed = rotate_snapshots(backup_dir, settings.BACKUP_KEEP, exclude)
+    logger.info(
+        f"Backup {name} written in {time.monotonic() - started:.1f}s ({os.path.getsize(path)} bytes)"
+        + (f", {len(removed)} old snapshots removed" if removed else "")
+    )
+    return path
+
+def restore_snapshot(path: str, db_path: str = None) -> str:
+    """
+    Replaces the contents of the live database with a snapshot. The snapshot is unpacked
+    and integrity-checked first, then a snapshot of the current state is taken (returned,
+    so the restore can be undone), and the pages are copied in one backup step. The copy
+    holds the write lock for its whole duration, so other connections see either the old
+    or the new database, never a mix, and WAL files stay consistent.
+    """
+    db_path = db_path or settings.DB_NAME
+    raw_path = os.path.join(os.path.dirname(path), ".restore.tmp")
+    try:
+        with gzip.open(path, "rb") as packed, open(raw_path, "wb") as raw:
+            shutil.copyfileobj(packed, raw, COPY_CHUNK)
+        error = _integrity_error(raw_path)
+        if error:
+            raise Exception(f"Snapshot {os.path.basename(path)} failed integrity check: {error}")
+        # The snapshot being restored may be the oldest one: rotation must not take it away
+        previous = create_snapshot(db_path, os.path.dirname(path), exclude=path)
+        _copy_database(raw_path, db_path, -1)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    logger.warning(f"Database restored from {os.path.basename(path)}, previous state saved as {os.path.basename(previous)}")
+    return previous
+
+def find_snapshot(name: str, backup_dir: str = None):
+    """Snapshot path by file name, None if there is no such snapshot (names are never used as paths)."""
+    for path in list_snapshots(backup_dir):
+        if os.path.basename(path) == name:
+            return path
+    return None
+
+async def backup_now() -> str:
+    async with _lock:
+        return await asyncio.to_thread(create_snapshot)
+
+async def restore(path: str) -> str:
+    """
+    restore_snapshot() with the current tenant's job queue and audit writer paused: claimed
+    jobs would be completed by id in the restored vpn_jobs, and buffered events would be
+    written into the restored database. Jobs claimed before are finished first, events
+    logged before are flushed into the old state, and those logged during the restore are
+    written after it.
+    """
+    async with _lock:
+        bot = job_queue.bot if job_queue.tasks else None
+        writing = audit_log.task is not None
+        await job_queue.stop(settings.SHUTDOWN_TIMEOUT)
+        await audit_log.stop()
+        try:
+            return await asyncio.to_thread(restore_snapshot, path)
+        finally:
+            if writing:
+                audit_log.start()
+            if bot:
+                # Re-queues the jobs the snapshot has as running
+                await job_queue.start(bot)
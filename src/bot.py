@@ -1,44 +1,156 @@
+import time
+_started = time.perf_counter()
+
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from config import settings
+from config import settings, use_settings
 from src.database import init_db, get_all_active_keys
+from src.catalog import load_catalog
+from src.audit import audit_log
+from src.jobs import job_queue
+from src.profiling import loop_lag_monitor
 from src.handlers import user, admin, payment
-from src.scheduler import setup_scheduler
-from src.vpn_service import vpn_service
+from src.scheduler import setup_scheduler, shutdown_scheduler
+from src.storage import create_storage
+from src.tenants import Tenant, load_tenants
+from src.vpn_service import peer_restorer
+from src.metrics import QUEUE_DEPTH, PhaseTimer, start_metrics_server
+from src.middlewares import InFlightMiddleware, MetricsMiddleware, TenantMiddleware, ThrottlingMiddleware, register_commands
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def main():
-    # Initialize Bot and Dispatcher
-    bot = Bot(token=settings.BOT_TOKEN)
-    dp = Dispatcher()
+def create_dispatcher(storage=None, tenants: list = None) -> Dispatcher:
+    """
+    Builds the Dispatcher with middlewares and routers. Shared by main() and the benchmarks.
+    One dispatcher serves the bots of all tenants; FSM keys include the bot id.
+    """
+    dp = Dispatcher(storage=storage) if storage else Dispatcher()
+
+    # Runs first: everything below sees the settings of the tenant the update came to
+    if tenants and len(tenants) > 1:
+        dp.update.outer_middleware(TenantMiddleware(tenants))
+
+    # Track in-flight updates for graceful shutdown
+    in_flight = InFlightMiddleware()
+    dp.update.outer_middleware(in_flight)
+    dp["in_flight"] = in_flight
+
+    # Metrics
+    metrics_middleware = MetricsMiddleware()
+    dp.message.middleware(metrics_middleware)
+    dp.callback_query.middleware(metrics_middleware)
+    dp.pre_checkout_query.middleware(metrics_middleware)
+
+    # Rate limiting and coalescing of user-facing buttons
+    throttling_middleware = ThrottlingMiddleware()
+    user.router.callback_query.middleware(throttling_middleware)
+    payment.router.callback_query.middleware(throttling_middleware)
+
+    # Register Routers
+    register_commands(user.router, admin.router, payment.router)
+    dp.include_router(user.router)
+    dp.include_router(admin.router)
+    dp.include_router(payment.router)
+    return dp
+
+async def start_tenant(tenant: Tenant, timer: PhaseTimer):
+    """DB, catalog, background writers and peer restore of one tenant. Runs in the tenant's context."""
+    # Phases of the default tenant keep their names, the others are prefixed with the tenant
+    prefix = "" if tenant.name == "default" else f"{tenant.name}."
 
     # Initialize Database
     await init_db()
+    timer.mark(prefix + "init_db")
+
+    await load_catalog()
+    timer.mark(prefix + "catalog")
+
+    audit_log.start()
+    await job_queue.start(tenant.bot)
 
-    # Restore VPN peers
+    # Restore VPN peers in the background, handlers only wait for the peers they touch
     try:
-        logger.info("Restoring VPN peers...")
         active_keys = await get_all_active_keys()
-        vpn_service.restore_peers(active_keys)
+        restore_started = time.perf_counter()
+
+        def restore_done(_):
+            elapsed = time.perf_counter() - restore_started
+            timer.record(prefix + "peer_restore_background", elapsed)
+            logger.info(f"Background restore of {len(active_keys)} peers of {tenant.name} took {elapsed:.3f}s")
+
+        peer_restorer.start(active_keys).add_done_callback(restore_done)
     except Exception as e:
-        logger.error(f"Failed to restore peers: {e}")
+        logger.error(f"Failed to restore peers of {tenant.name}: {e}")
+    timer.mark(prefix + "load_keys")
 
-    # Register Routers
-    dp.include_router(user.router)
-    dp.include_router(admin.router)
-    dp.include_router(payment.router)
+async def main():
+    timer = PhaseTimer(_started)
+    timer.mark("imports")
+
+    # Initialize Bots and Dispatcher: the .env bot plus the tenants of TENANTS_FILE
+    tenants = [Tenant(tenant_settings, Bot(token=tenant_settings.BOT_TOKEN)) for tenant_settings in load_tenants()]
+    storage = create_storage(settings.FSM_STORAGE, settings.DB_NAME)
+    dp = create_dispatcher(storage, tenants)
+    timer.mark("dispatcher")
+
+    for tenant in tenants:
+        with use_settings(tenant.settings):
+            await start_tenant(tenant, timer)
+    if settings.LOOP_LAG_THRESHOLD_MS:
+        loop_lag_monitor.start()
+
+    # Metrics endpoint, queues are summed over tenants
+    QUEUE_DEPTH.set_function(lambda: len(asyncio.all_tasks()), "asyncio_tasks")
+    QUEUE_DEPTH.set_function(lambda: dp["in_flight"].count, "in_flight_updates")
+    QUEUE_DEPTH.set_function(lambda: sum(len(writer.buffer) for writer in audit_log.instances()), "audit_log")
+    QUEUE_DEPTH.set_function(lambda: sum(queue.depth for queue in job_queue.instances()), "vpn_jobs")
+    metrics_runner = None
+    if settings.METRICS_PORT:
+        metrics_runner = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+    timer.mark("metrics")
 
     # Setup Scheduler
-    setup_scheduler(bot)
+    scheduler = setup_scheduler(tenants)
+    timer.mark("scheduler")
+
+    # Start Polling. Unless DROP_PENDING_UPDATES is set, updates queued while the bot
+    # was down (including successful_payment) are processed after a restart.
+    logger.info(f"Starting {len(tenants)} bot(s): {', '.join(tenant.name for tenant in tenants)}")
+    await asyncio.gather(*(
+        tenant.bot.delete_webhook(drop_pending_updates=tenant.settings.DROP_PENDING_UPDATES) for tenant in tenants
+    ))
+    timer.mark("delete_webhook")
+    logger.info(f"Startup: {timer.summary()}")
+    try:
+        # SIGTERM/SIGINT stop polling; the sessions stay open until in-flight work is drained
+        await dp.start_polling(*(tenant.bot for tenant in tenants), close_bot_session=False)
+    finally:
+        await shutdown(tenants, dp, scheduler, storage, metrics_runner)
+
+async def stop_tenant(tenant: Tenant, timeout: float):
+    with use_settings(tenant.settings):
+        await job_queue.stop(timeout)
+        if peer_restorer.task and not peer_restorer.task.done():
+            peer_restorer.task.cancel()
+        await audit_log.stop()
 
-    # Start Polling
-    logger.info("Starting bot...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+async def shutdown(tenants, dp, scheduler, storage, metrics_runner):
+    """Drains in-flight updates and scheduled jobs, then releases resources."""
+    timeout = settings.SHUTDOWN_TIMEOUT
+    logger.info(f"Shutting down, waiting up to {timeout}s for in-flight work...")
+    if not await dp["in_flight"].wait_idle(timeout):
+        logger.warning(f"{dp['in_flight'].count} updates still in flight at shutdown")
+    await shutdown_scheduler(scheduler, timeout)
+    await asyncio.gather(*(stop_tenant(tenant, timeout) for tenant in tenants))
+    await loop_lag_monitor.stop()
+    await storage.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    for tenant in tenants:
+        await tenant.bot.session.close()
 
 if __name__ == "__main__":
     try:
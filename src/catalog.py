@@ -0,0 +1,70 @@
+from types import MappingProxyType
+from typing import NamedTuple
+from config import settings
+from src.database import get_products, seed_products, update_product_price
+from src.metrics import record_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION = "subscription"
+SLOT = "slot"
+
+class Product(NamedTuple):
+    payload: str  # invoice payload, must stay stable: paid invoices are matched by it
+    code: str  # callback_data is buy_<code>
+    kind: str  # SUBSCRIPTION or SLOT
+    label: str  # button text without price
+    title: str
+    description: str
+    price: int  # RUB
+    days: int
+    sort_order: int = 0
+    is_active: bool = True
+
+class Catalog:
+    """Immutable product index. Reloading builds a new Catalog and swaps it in."""
+
+    def __init__(self, products):
+        self.products = tuple(sorted(products, key=lambda p: p.sort_order))
+        self.by_payload = MappingProxyType({p.payload: p for p in self.products})
+        self.by_code = MappingProxyType({p.code: p for p in self.products})
+        # Shown in the "buy subscription" menu
+        self.subscriptions = tuple(p for p in self.products if p.kind == SUBSCRIPTION and p.is_active)
+
+def default_products() -> list:
+    """Plans as they were hardcoded before the catalog, used to seed the products table."""
+    return [
+        Product("sub_30", "1", SUBSCRIPTION, "1 Месяц", "VPN - 1 Месяц", "Доступ к VPN на 30 дней", settings.PRICE_1_MONTH, 30, 1),
+        Product("sub_90", "3", SUBSCRIPTION, "3 Месяца", "VPN - 3 Месяца", "Доступ к VPN на 90 дней", settings.PRICE_3_MONTHS, 90, 2),
+        Product("sub_365", "12", SUBSCRIPTION, "1 Год", "VPN - 1 Год", "Доступ к VPN на 365 дней", settings.PRICE_12_MONTHS, 365, 3),
+        Product("buy_slot", "slot", SLOT, "Слот (+1)", "Дополнительный слот", "Дополнительное устройство для VPN", settings.PRICE_SLOT, 0, 4),
+    ]
+
+# One catalog per tenant
+_catalogs = {}
+
+def get_catalog() -> Catalog:
+    catalog = _catalogs.get(settings.TENANT)
+    record_cache("catalog", catalog is not None)
+    if catalog is None:
+        # Usable before load_catalog(), e.g. in benchmarks
+        catalog = _catalogs[settings.TENANT] = Catalog(default_products())
+    return catalog
+
+async def load_catalog() -> Catalog:
+    """Loads products from the DB (seeding it on first run) and swaps the in-memory index."""
+    rows = await get_products()
+    if not rows:
+        await seed_products(default_products())
+        rows = await get_products()
+    catalog = _catalogs[settings.TENANT] = Catalog(Product(**{field: row[field] for field in Product._fields}) for row in rows)
+    logger.info(f"Catalog loaded: {len(catalog.products)} products")
+    return catalog
+
+async def set_price(payload: str, price: int) -> bool:
+    """Hot price change: updates the DB and reloads the catalog, no restart needed."""
+    if not await update_product_price(payload, price):
+        return False
+    await load_catalog()
+    return True
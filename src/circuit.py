@@ -0,0 +1,69 @@
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency that is known to be down."""
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and then fails fast for
+    `reset_timeout` seconds. After that a single probe call is let through: success
+    closes the circuit, failure opens it for another period. Thread-safe, because
+    VpnService is called both from the event loop and from worker threads.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until calls are let through again, 0 if they are now."""
+        if self.state == CLOSED:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != CLOSED and self.retry_in > 0
+
+    def _allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.retry_in == 0:
+                self.state = HALF_OPEN  # this caller is the probe
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        if not self._allow():
+            raise CircuitOpen(f"{self.name} is unavailable, retry in {self.retry_in:.0f}s")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
@@ -1,11 +1,12 @@
 import aiosqlite
 import datetime
 from config import settings
+from src.metrics import db_timed
 
-DB_PATH = settings.DB_NAME
 
+@db_timed
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -15,6 +16,7 @@ async def init_db():
                 referrer_id INTEGER,
                 referral_count INTEGER DEFAULT 0,
                 max_devices INTEGER DEFAULT 2,
+                plan TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
@@ -25,9 +27,11 @@ async def init_db():
                 public_key TEXT,
                 private_key TEXT,
                 ip_address TEXT,
+                ip6_address TEXT,
                 config TEXT,
                 device_name TEXT,
                 is_active BOOLEAN DEFAULT 1,
+                shard INTEGER DEFAULT 0,
                 FOREIGN KEY(user_id) REFERENCES users(id)
             )
         """)
@@ -41,16 +45,137 @@ async def init_db():
                 FOREIGN KEY(user_id) REFERENCES users(id)
             )
         """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS products (
+                payload TEXT PRIMARY KEY,
+                code TEXT UNIQUE,
+                kind TEXT,
+                label TEXT,
+                title TEXT,
+                description TEXT,
+                price INTEGER,
+                days INTEGER,
+                sort_order INTEGER DEFAULT 0,
+                is_active BOOLEAN DEFAULT 1
+            )
+        """)
+        referral_events_existed = await _table_exists(db, "referral_events")
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS referral_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                referrer_id INTEGER,
+                referee_id INTEGER,
+                level INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                rewarded_at TIMESTAMP,
+                UNIQUE(referrer_id, referee_id)
+            )
+        """)
+        # One row per reminder sent for a given subscription end, a renewal starts a new series
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS sent_reminders (
+                end_date TEXT,
+                telegram_id INTEGER,
+                offset_seconds INTEGER,
+                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (end_date, telegram_id, offset_seconds)
+            ) WITHOUT ROWID
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP,
+                event TEXT,
+                telegram_id INTEGER,
+                actor_id INTEGER,
+                details TEXT
+            )
+        """)
+        # Append-only: history can be added to, never rewritten
+        for statement in ("UPDATE", "DELETE"):
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS audit_log_no_{statement.lower()} BEFORE {statement} ON audit_log
+                BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+            """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS vpn_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT,
+                telegram_id INTEGER,
+                payload TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                run_at TEXT,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Migrations for databases created by older versions
+        await _add_column_if_missing(db, "keys", "ip6_address", "TEXT")
+        await _add_column_if_missing(db, "keys", "shard", "INTEGER DEFAULT 0")
+        await _add_column_if_missing(db, "users", "plan", "TEXT")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_keys_shard_active ON keys(shard, is_active)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_keys_user_active ON keys(user_id, is_active)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id)")
+        # Admin search by username prefix, case-insensitive like Telegram usernames
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_vpn_jobs_due ON vpn_jobs(status, run_at)")
+        # At most one queued provisioning job per user
+        await db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_vpn_jobs_provision ON vpn_jobs(telegram_id) WHERE kind = 'provision' AND status != 'failed'"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_user ON audit_log(telegram_id, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_actor ON audit_log(actor_id, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users(subscription_end_date, telegram_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_referral_events_referee ON referral_events(referee_id)")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_referral_events_pending ON referral_events(referrer_id, level) WHERE rewarded_at IS NULL"
+        )
+        if not referral_events_existed:
+            await _backfill_referral_events(db)
         await db.commit()
 
+async def _table_exists(db, table: str) -> bool:
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)) as cursor:
+        return await cursor.fetchone() is not None
+
+async def _backfill_referral_events(db):
+    # Older versions only kept users.referral_count. Referees who ever had a subscription are
+    # recorded as already rewarded, except the latest referral_count ones of each referrer,
+    # which keep counting towards the next reward.
+    await db.execute("""
+        INSERT OR IGNORE INTO referral_events (referrer_id, referee_id, level, created_at, rewarded_at)
+        SELECT referrer_id, telegram_id, 1, created_at, created_at FROM users
+        WHERE referrer_id IS NOT NULL AND referrer_id != telegram_id AND subscription_end_date IS NOT NULL
+        ORDER BY id
+    """)
+    await db.execute("""
+        UPDATE referral_events SET rewarded_at = NULL WHERE id IN (
+            SELECT e.id FROM (
+                SELECT id, referrer_id, ROW_NUMBER() OVER (PARTITION BY referrer_id ORDER BY id DESC) AS n
+                FROM referral_events
+            ) e
+            JOIN users u ON u.telegram_id = e.referrer_id
+            WHERE e.n <= u.referral_count
+        )
+    """)
+
+async def _add_column_if_missing(db, table: str, column: str, declaration: str):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+@db_timed
 async def get_user(telegram_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)) as cursor:
             return await cursor.fetchone()
 
+@db_timed
 async def create_user(telegram_id: int, username: str, referrer_id: int = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         try:
             await db.execute(
                 "INSERT INTO users (telegram_id, username, referrer_id) VALUES (?, ?, ?)",
@@ -61,8 +186,10 @@ async def create_user(telegram_id: int, username: str, referrer_id: int = None):
         except aiosqlite.IntegrityError:
             return False
 
-async def update_subscription(telegram_id: int, days: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def update_subscription(telegram_id: int, days: int, plan: str = None):
+    # plan: payload of the purchased product, selects the bandwidth class; None keeps the current one
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         user = await get_user(telegram_id)
         current_end = None
         
@@ -77,105 +204,219 @@ async def update_subscription(telegram_id: int, days: int):
             new_end = now + datetime.timedelta(days=days)
             
         await db.execute(
-            "UPDATE users SET subscription_end_date = ? WHERE telegram_id = ?",
-            (new_end.isoformat(), telegram_id)
+            "UPDATE users SET subscription_end_date = ?, plan = COALESCE(?, plan) WHERE telegram_id = ?",
+            (new_end.isoformat(), plan, telegram_id)
         )
         await db.commit()
         return new_end
 
-async def disable_subscription(telegram_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        now = datetime.datetime.now()
+@db_timed
+async def save_key(user_id: int, public_key: str, private_key: str, ip_address: str, config: str, device_name: str = "Device 1", ip6_address: str = None, shard: int = 0):
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         await db.execute(
-            "UPDATE users SET subscription_end_date = ? WHERE telegram_id = ?",
-            (now.isoformat(), telegram_id)
-        )
-        await db.commit()
-
-async def add_referral_count(referrer_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET referral_count = referral_count + 1 WHERE telegram_id = ?",
-            (referrer_id,)
-        )
-        await db.commit()
-
-async def reset_referral_count(referrer_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET referral_count = 0 WHERE telegram_id = ?",
-            (referrer_id,)
-        )
-        await db.commit()
-
-async def save_key(user_id: int, public_key: str, private_key: str, ip_address: str, config: str, device_name: str = "Device 1"):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO keys (user_id, public_key, private_key, ip_address, config, device_name) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, public_key, private_key, ip_address, config, device_name)
+            "INSERT INTO keys (user_id, public_key, private_key, ip_address, config, device_name, ip6_address, shard) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, public_key, private_key, ip_address, config, device_name, ip6_address, shard)
         )
         await db.commit()
 
+@db_timed
 async def get_user_keys(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM keys WHERE user_id = ? AND is_active = 1", (user_id,)) as cursor:
             return await cursor.fetchall()
 
+@db_timed
 async def count_user_keys(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         async with db.execute("SELECT COUNT(*) FROM keys WHERE user_id = ? AND is_active = 1", (user_id,)) as cursor:
             result = await cursor.fetchone()
             return result[0] if result else 0
 
+@db_timed
 async def get_user_key(user_id: int):
     # Deprecated: Use get_user_keys instead. Kept for backward compatibility, returns the first key.
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM keys WHERE user_id = ? AND is_active = 1 LIMIT 1", (user_id,)) as cursor:
             return await cursor.fetchone()
 
-async def get_all_used_ips():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Get IPs from active keys
-        async with db.execute("SELECT ip_address FROM keys WHERE is_active = 1") as cursor:
+# View queries: everything one screen needs in a single query, for many users at once
+# (src.loaders batches the loads of concurrent updates into one call)
+
+@db_timed
+async def get_profile_views(telegram_ids: list) -> dict:
+    """telegram_id -> users row plus key_count, the number of active keys."""
+    if not telegram_ids:
+        return {}
+    query = f"""
+        SELECT u.*, (SELECT count(*) FROM keys k WHERE k.user_id = u.id AND k.is_active = 1) AS key_count
+        FROM users u WHERE u.telegram_id IN ({_placeholders(telegram_ids)})
+    """
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(query, telegram_ids) as cursor:
+            return {row['telegram_id']: row for row in await cursor.fetchall()}
+
+@db_timed
+async def get_devices_views(telegram_ids: list) -> dict:
+    """telegram_id -> (user, active keys as (id, device_name) rows) for the devices screen."""
+    if not telegram_ids:
+        return {}
+    query = f"""
+        SELECT u.id AS user_id, u.telegram_id, u.max_devices, u.subscription_end_date, k.id, k.device_name
+        FROM users u LEFT JOIN keys k ON k.user_id = u.id AND k.is_active = 1
+        WHERE u.telegram_id IN ({_placeholders(telegram_ids)})
+        ORDER BY u.telegram_id, k.id
+    """
+    views = {}
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(query, telegram_ids) as cursor:
+            async for row in cursor:
+                user, keys = views.setdefault(row['telegram_id'], (row, []))
+                if row['id'] is not None:
+                    keys.append(row)
+    return views
+
+@db_timed
+async def get_key_views(pairs: list) -> dict:
+    """
+    (telegram_id, key_id) -> the key row joined with its owner's subscription_end_date and plan.
+    Ownership is part of the join: key columns are NULL if the key is not an active key
+    of that user. Users that do not exist are missing from the result.
+    """
+    if not pairs:
+        return {}
+    query = f"""
+        WITH wanted(owner_id, key_id) AS (VALUES {",".join(["(?, ?)"] * len(pairs))})
+        SELECT w.owner_id, w.key_id, u.subscription_end_date, u.plan, k.*
+        FROM wanted w
+        JOIN users u ON u.telegram_id = w.owner_id
+        LEFT JOIN keys k ON k.id = w.key_id AND k.user_id = u.id AND k.is_active = 1
+    """
+    params = [value for pair in pairs for value in pair]
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(query, params) as cursor:
+            return {(row['owner_id'], row['key_id']): row for row in await cursor.fetchall()}
+
+@db_timed
+async def get_all_used_ips(shard: int = 0):
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        # Get IPs from active keys, every shard has its own subnet
+        async with db.execute("SELECT ip_address FROM keys WHERE is_active = 1 AND shard = ?", (shard,)) as cursor:
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
 
+@db_timed
 async def get_all_active_keys():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT public_key, ip_address FROM keys WHERE is_active = 1") as cursor:
+        query = """
+            SELECT k.public_key, k.ip_address, k.ip6_address, k.shard, u.plan
+            FROM keys k LEFT JOIN users u ON u.id = k.user_id
+            WHERE k.is_active = 1
+        """
+        async with db.execute(query) as cursor:
             return await cursor.fetchall()
 
+@db_timed
+async def get_active_key_shards(public_keys: list) -> dict:
+    """public_key -> shard for those of public_keys that belong to active keys."""
+    active = {}
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        for i in range(0, len(public_keys), BULK_BATCH_SIZE):
+            batch = public_keys[i:i + BULK_BATCH_SIZE]
+            async with db.execute(
+                f"SELECT public_key, shard FROM keys WHERE is_active = 1 AND public_key IN ({_placeholders(batch)})",
+                batch
+            ) as cursor:
+                active.update((key, shard or 0) for key, shard in await cursor.fetchall())
+    return active
+
+@db_timed
 async def delete_key_by_id(key_id: int, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Verify ownership and get public key to remove from WG
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        # Verify ownership and get public key, address and shard to remove from WG
         db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT public_key FROM keys WHERE id = ? AND user_id = ?", (key_id, user_id)) as cursor:
+        async with db.execute("SELECT public_key, ip_address, shard FROM keys WHERE id = ? AND user_id = ?", (key_id, user_id)) as cursor:
             row = await cursor.fetchone()
             if row:
-                public_key = row['public_key']
                 await db.execute("UPDATE keys SET is_active = 0 WHERE id = ?", (key_id,))
                 await db.commit()
-                return public_key
+                return row
             return None
 
 
+@db_timed
+async def search_users(query: str = "", cursor_id: int = None, backward: bool = False, limit: int = 10):
+    """
+    Admin user search with keyset pagination, never OFFSET. query: "" lists all users newest
+    first, digits look up a telegram_id, anything else is a username prefix (ordered by
+    username, served by idx_users_username). cursor_id is users.id of the last row of the
+    current page, or the first one when paging backward; the cursor is part of the index
+    range, so deep pages cost the same as the first one.
+    Returns (rows in display order, has_more in the paging direction).
+    """
+    columns = "SELECT id, telegram_id, username, subscription_end_date FROM users"
+    if query.isdigit():
+        sql, params = f"{columns} WHERE telegram_id = ?", (int(query),)
+    elif not query:
+        if cursor_id is None:
+            sql, params = f"{columns} ORDER BY id DESC LIMIT ?", (limit + 1,)
+        elif backward:
+            sql, params = f"{columns} WHERE id > ? ORDER BY id ASC LIMIT ?", (cursor_id, limit + 1)
+        else:
+            sql, params = f"{columns} WHERE id < ? ORDER BY id DESC LIMIT ?", (cursor_id, limit + 1)
+    else:
+        low = query.lower()
+        high = low[:-1] + chr(ord(low[-1]) + 1)
+        cursor_name = "(SELECT lower(username) FROM users WHERE id = ?)"
+        if cursor_id is None:
+            sql = f"""{columns}
+                WHERE username COLLATE NOCASE >= ? AND username COLLATE NOCASE < ?
+                ORDER BY username COLLATE NOCASE, id LIMIT ?"""
+            params = (low, high, limit + 1)
+        elif backward:
+            sql = f"""{columns}
+                WHERE username COLLATE NOCASE >= ? AND username COLLATE NOCASE <= {cursor_name}
+                AND (username COLLATE NOCASE < {cursor_name} OR id < ?)
+                ORDER BY username COLLATE NOCASE DESC, id DESC LIMIT ?"""
+            params = (low, cursor_id, cursor_id, cursor_id, limit + 1)
+        else:
+            sql = f"""{columns}
+                WHERE username COLLATE NOCASE >= max(?, {cursor_name}) AND username COLLATE NOCASE < ?
+                AND (username COLLATE NOCASE > {cursor_name} OR id > ?)
+                ORDER BY username COLLATE NOCASE, id LIMIT ?"""
+            params = (low, cursor_id, high, cursor_id, cursor_id, limit + 1)
+
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+@db_timed
 async def get_all_active_subs():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         now = datetime.datetime.now().isoformat()
         async with db.execute("SELECT * FROM users WHERE subscription_end_date > ?", (now,)) as cursor:
             return await cursor.fetchall()
 
+@db_timed
 async def get_expired_subs():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         db.row_factory = aiosqlite.Row
         now = datetime.datetime.now().isoformat()
         # Get users who have expired but still have active keys
         query = """
-            SELECT u.*, k.public_key 
+            SELECT u.*, k.public_key, k.ip_address, k.shard
             FROM users u 
             JOIN keys k ON u.id = k.user_id 
             WHERE u.subscription_end_date < ? AND k.is_active = 1
@@ -183,15 +424,475 @@ async def get_expired_subs():
         async with db.execute(query, (now,)) as cursor:
             return await cursor.fetchall()
 
+@db_timed
 async def deactivate_key(public_key: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         await db.execute("UPDATE keys SET is_active = 0 WHERE public_key = ?", (public_key,))
         await db.commit()
 
+@db_timed
+async def deactivate_keys(public_keys: list):
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        for i in range(0, len(public_keys), BULK_BATCH_SIZE):
+            batch = public_keys[i:i + BULK_BATCH_SIZE]
+            await db.execute(f"UPDATE keys SET is_active = 0 WHERE public_key IN ({_placeholders(batch)})", batch)
+        await db.commit()
+
+@db_timed
+async def count_active_keys_by_shard() -> dict:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        async with db.execute("SELECT shard, COUNT(*) FROM keys WHERE is_active = 1 GROUP BY shard") as cursor:
+            return {shard or 0: count for shard, count in await cursor.fetchall()}
+
+@db_timed
 async def increment_max_devices(telegram_id: int, count: int = 1):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
         await db.execute(
             "UPDATE users SET max_devices = max_devices + ? WHERE telegram_id = ?",
             (count, telegram_id)
         )
         await db.commit()
+
+# Bulk operations
+
+BULK_BATCH_SIZE = 500
+
+def _placeholders(values) -> str:
+    return ",".join("?" * len(values))
+
+@db_timed
+async def get_telegram_ids_by_filter(target: str):
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        now = datetime.datetime.now().isoformat()
+        if target == "active":
+            query, params = "SELECT telegram_id FROM users WHERE subscription_end_date > ?", (now,)
+        elif target == "expired":
+            query, params = "SELECT telegram_id FROM users WHERE subscription_end_date <= ?", (now,)
+        elif target == "all":
+            query, params = "SELECT telegram_id FROM users", ()
+        else:
+            raise ValueError(f"Unknown filter: {target}")
+        async with db.execute(query, params) as cursor:
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+
+@db_timed
+async def bulk_update_subscriptions(telegram_ids: list, days: int):
+    # Same semantics as update_subscription, but for a whole batch in one statement:
+    # active subscriptions are extended, expired ones start from now.
+    if not telegram_ids:
+        return 0
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        now = datetime.datetime.now().isoformat()
+        cursor = await db.execute(
+            f"""
+            UPDATE users SET subscription_end_date = strftime(
+                '%Y-%m-%dT%H:%M:%f',
+                CASE WHEN subscription_end_date > ? THEN subscription_end_date ELSE ? END,
+                ?
+            )
+            WHERE telegram_id IN ({_placeholders(telegram_ids)})
+            """,
+            (now, now, f"{days:+d} days", *telegram_ids)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@db_timed
+async def bulk_disable_subscriptions(telegram_ids: list):
+    """Ends subscriptions and deactivates keys for a batch. Returns the deactivated keys (public_key, ip_address, shard)."""
+    if not telegram_ids:
+        return []
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        now = datetime.datetime.now().isoformat()
+        marks = _placeholders(telegram_ids)
+        user_ids_query = f"SELECT id FROM users WHERE telegram_id IN ({marks})"
+        async with db.execute(
+            f"SELECT public_key, ip_address, shard FROM keys WHERE is_active = 1 AND user_id IN ({user_ids_query})",
+            telegram_ids
+        ) as cursor:
+            keys = await cursor.fetchall()
+        await db.execute(
+            f"UPDATE keys SET is_active = 0 WHERE is_active = 1 AND user_id IN ({user_ids_query})",
+            telegram_ids
+        )
+        await db.execute(
+            f"UPDATE users SET subscription_end_date = ? WHERE telegram_id IN ({marks})",
+            (now, *telegram_ids)
+        )
+        await db.commit()
+        return keys
+
+@db_timed
+async def get_users_without_keys(telegram_ids: list):
+    """Users with an active subscription and no active key, i.e. the ones to provision."""
+    if not telegram_ids:
+        return []
+    now = datetime.datetime.now().isoformat()
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        query = f"""
+            SELECT u.id, u.telegram_id, u.plan
+            FROM users u
+            WHERE u.telegram_id IN ({_placeholders(telegram_ids)})
+            AND u.subscription_end_date > ?
+            AND NOT EXISTS (SELECT 1 FROM keys k WHERE k.user_id = u.id AND k.is_active = 1)
+        """
+        async with db.execute(query, [*telegram_ids, now]) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def save_keys(keys: list):
+    # keys: list of (user_id, public_key, private_key, ip_address, config, device_name, ip6_address, shard)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.executemany(
+            "INSERT INTO keys (user_id, public_key, private_key, ip_address, config, device_name, ip6_address, shard) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            keys
+        )
+        await db.commit()
+
+# Product catalog
+
+@db_timed
+async def get_products():
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("SELECT * FROM products ORDER BY sort_order") as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def seed_products(products: list):
+    # products: Product tuples in table column order, existing payloads are kept as is
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO products (payload, code, kind, label, title, description, price, days, sort_order, is_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            products
+        )
+        await db.commit()
+
+@db_timed
+async def update_product_price(payload: str, price: int) -> bool:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        cursor = await db.execute("UPDATE products SET price = ? WHERE payload = ?", (price, payload))
+        await db.commit()
+        return cursor.rowcount > 0
+
+# Referrals
+# referral_events has one row per (ancestor, referee) pair: level 1 is the direct referrer,
+# deeper levels are only recorded when multi-level rewards are configured.
+
+@db_timed
+async def record_referral(referee_id: int, levels: list) -> list:
+    """
+    Records a paid subscription of referee_id for its referrer chain and pays out the rewards.
+    levels: (level, threshold, days) rows. A repeat purchase inserts nothing and pays nothing.
+    Returns (referrer telegram_id, days) pairs that were granted.
+    """
+    max_level = max(level for level, _, _ in levels)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        cursor = await db.execute(
+            """
+            INSERT OR IGNORE INTO referral_events (referrer_id, referee_id, level)
+            WITH RECURSIVE chain(referrer_id, level) AS (
+                SELECT referrer_id, 1 FROM users WHERE telegram_id = ? AND referrer_id IS NOT NULL
+                UNION ALL
+                SELECT u.referrer_id, c.level + 1
+                FROM chain c JOIN users u ON u.telegram_id = c.referrer_id
+                WHERE u.referrer_id IS NOT NULL AND c.level < ?
+            )
+            SELECT referrer_id, ?, level FROM chain WHERE referrer_id != ?
+            """,
+            (referee_id, max_level, referee_id, referee_id)
+        )
+        if cursor.rowcount <= 0:
+            await db.commit()
+            return []
+        grants = await _pay_referral_rewards(db, levels, referee_id)
+        await db.commit()
+        return grants
+
+@db_timed
+async def pay_referral_rewards(levels: list) -> list:
+    # Settles every pending event, e.g. after the reward settings were lowered
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        grants = await _pay_referral_rewards(db, levels)
+        await db.commit()
+        return grants
+
+async def _pay_referral_rewards(db, levels: list, referee_id: int = None) -> list:
+    # Complete groups of `threshold` unrewarded events per (referrer, level) are marked rewarded
+    # and the sum of their days is added to each referrer's subscription, all in SQL.
+    rules = ", ".join("(?, ?, ?)" for _ in levels)
+    params = [value for rule in levels for value in rule]
+    scope = ""
+    if referee_id is not None:
+        scope = "AND e.referrer_id IN (SELECT referrer_id FROM referral_events WHERE referee_id = ?)"
+        params.append(referee_id)
+
+    await db.execute("CREATE TEMP TABLE IF NOT EXISTS referral_payouts (event_id INTEGER, referrer_id INTEGER, days INTEGER)")
+    await db.execute("DELETE FROM referral_payouts")
+    await db.execute(
+        f"""
+        INSERT INTO referral_payouts (event_id, referrer_id, days)
+        WITH rules(level, threshold, days) AS (VALUES {rules}),
+        pending AS (
+            SELECT e.id, e.referrer_id, r.threshold, r.days,
+                   ROW_NUMBER() OVER (PARTITION BY e.referrer_id, e.level ORDER BY e.id) AS n,
+                   COUNT(*) OVER (PARTITION BY e.referrer_id, e.level) AS total
+            FROM referral_events e JOIN rules r ON r.level = e.level
+            WHERE e.rewarded_at IS NULL AND r.threshold > 0 {scope}
+        )
+        SELECT id, referrer_id, CASE WHEN n % threshold = 0 THEN days ELSE 0 END
+        FROM pending WHERE n <= total - total % threshold
+        """,
+        params
+    )
+    now = datetime.datetime.now().isoformat()
+    await db.execute(
+        "UPDATE referral_events SET rewarded_at = ? WHERE id IN (SELECT event_id FROM referral_payouts)",
+        (now,)
+    )
+    await db.execute(
+        """
+        UPDATE users SET subscription_end_date = strftime(
+            '%Y-%m-%dT%H:%M:%f',
+            CASE WHEN subscription_end_date > ? THEN subscription_end_date ELSE ? END,
+            '+' || (SELECT SUM(days) FROM referral_payouts p WHERE p.referrer_id = users.telegram_id) || ' days'
+        )
+        WHERE telegram_id IN (SELECT referrer_id FROM referral_payouts WHERE days > 0)
+        """,
+        (now, now)
+    )
+    async with db.execute(
+        """
+        SELECT p.referrer_id, SUM(p.days) FROM referral_payouts p
+        JOIN users u ON u.telegram_id = p.referrer_id
+        GROUP BY p.referrer_id HAVING SUM(p.days) > 0
+        """
+    ) as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+@db_timed
+async def get_referral_stats(telegram_id: int):
+    # direct: paying direct referrals, pending: not yet rewarded ones, network: paying referees on all levels
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            """
+            SELECT COUNT(*) FILTER (WHERE level = 1) AS direct,
+                   COUNT(*) FILTER (WHERE level = 1 AND rewarded_at IS NULL) AS pending,
+                   COUNT(*) AS network
+            FROM referral_events WHERE referrer_id = ?
+            """,
+            (telegram_id,)
+        ) as cursor:
+            return await cursor.fetchone()
+
+@db_timed
+async def get_referral_leaderboard(limit: int = 10):
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            """
+            SELECT e.referrer_id, u.username,
+                   COUNT(*) FILTER (WHERE e.level = 1) AS direct,
+                   COUNT(*) AS network
+            FROM referral_events e LEFT JOIN users u ON u.telegram_id = e.referrer_id
+            GROUP BY e.referrer_id
+            ORDER BY direct DESC, network DESC
+            LIMIT ?
+            """,
+            (limit,)
+        ) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def get_referral_tree(telegram_id: int, max_depth: int = 3, limit: int = 100):
+    # Invited users below telegram_id in depth-first order; paid marks referees that bought a subscription
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute(
+            """
+            WITH RECURSIVE tree(telegram_id, username, depth, path) AS (
+                SELECT telegram_id, username, 1, printf('%020d', telegram_id)
+                FROM users WHERE referrer_id = ?
+                UNION ALL
+                SELECT u.telegram_id, u.username, t.depth + 1, t.path || '/' || printf('%020d', u.telegram_id)
+                FROM tree t JOIN users u ON u.referrer_id = t.telegram_id
+                WHERE t.depth < ? AND u.telegram_id != ?
+            )
+            SELECT t.telegram_id, t.username, t.depth,
+                   EXISTS (SELECT 1 FROM referral_events e WHERE e.referee_id = t.telegram_id AND e.level = 1) AS paid
+            FROM tree t ORDER BY t.path LIMIT ?
+            """,
+            (telegram_id, max_depth, telegram_id, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+# Expiry reminders
+
+@db_timed
+async def get_reminder_batch(start: str, end: str, offset_seconds: int, after: tuple = None, limit: int = BULK_BATCH_SIZE):
+    """
+    Users whose subscription ends in (start, end] and who have not got the offset_seconds reminder
+    for that end date yet. Keyset pagination: pass the last (subscription_end_date, telegram_id) as after.
+    """
+    after = after or (start, 0)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        query = """
+            SELECT u.telegram_id, u.subscription_end_date
+            FROM users u
+            WHERE u.subscription_end_date > ? AND u.subscription_end_date <= ?
+            AND (u.subscription_end_date, u.telegram_id) > (?, ?)
+            AND NOT EXISTS (
+                SELECT 1 FROM sent_reminders r
+                WHERE r.end_date = u.subscription_end_date AND r.telegram_id = u.telegram_id AND r.offset_seconds = ?
+            )
+            ORDER BY u.subscription_end_date, u.telegram_id
+            LIMIT ?
+        """
+        async with db.execute(query, (start, end, *after, offset_seconds, limit)) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def save_sent_reminders(reminders: list):
+    # reminders: list of (end_date, telegram_id, offset_seconds)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.executemany(
+            "INSERT OR IGNORE INTO sent_reminders (end_date, telegram_id, offset_seconds) VALUES (?, ?, ?)",
+            reminders
+        )
+        await db.commit()
+
+@db_timed
+async def delete_sent_reminders_before(end_date: str) -> int:
+    # Reminders of subscriptions that already ended can no longer be selected again
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        cursor = await db.execute("DELETE FROM sent_reminders WHERE end_date <= ?", (end_date,))
+        await db.commit()
+        return cursor.rowcount
+
+# Audit log
+
+@db_timed
+async def save_audit_events(events: list):
+    # events: list of (created_at, event, telegram_id, actor_id, details)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.executemany(
+            "INSERT INTO audit_log (created_at, event, telegram_id, actor_id, details) VALUES (?, ?, ?, ?, ?)",
+            events
+        )
+        await db.commit()
+
+@db_timed
+async def get_user_history(telegram_id: int, limit: int = 20, before_id: int = None):
+    """
+    Events about a user or performed by them, newest first.
+    Keyset pagination: pass the smallest id of the previous page as before_id.
+    """
+    before_id = before_id or 2**63 - 1
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        query = """
+            SELECT * FROM (
+                SELECT * FROM audit_log WHERE telegram_id = ? AND id < ?
+                UNION
+                SELECT * FROM audit_log WHERE actor_id = ? AND id < ?
+            )
+            ORDER BY id DESC LIMIT ?
+        """
+        async with db.execute(query, (telegram_id, before_id, telegram_id, before_id, limit)) as cursor:
+            return await cursor.fetchall()
+
+@db_timed
+async def get_audit_events(event: str = None, limit: int = 50):
+    # Latest events, optionally of one type (e.g. "admin.sync")
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        if event:
+            query, params = "SELECT * FROM audit_log WHERE event = ? ORDER BY id DESC LIMIT ?", (event, limit)
+        else:
+            query, params = "SELECT * FROM audit_log ORDER BY id DESC LIMIT ?", (limit,)
+        async with db.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+# VPN job queue: status is pending, running or failed; finished jobs are deleted
+
+@db_timed
+async def enqueue_jobs(jobs: list) -> int:
+    # jobs: list of (kind, telegram_id, payload json); duplicate provisioning jobs are ignored
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        now = datetime.datetime.now().isoformat()
+        cursor = await db.executemany(
+            "INSERT OR IGNORE INTO vpn_jobs (kind, telegram_id, payload, run_at) VALUES (?, ?, ?, ?)",
+            [(kind, telegram_id, payload, now) for kind, telegram_id, payload in jobs]
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@db_timed
+async def claim_jobs(limit: int):
+    """Atomically marks up to `limit` due jobs as running and returns them, oldest first."""
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        db.row_factory = aiosqlite.Row
+        now = datetime.datetime.now().isoformat()
+        async with db.execute(
+            """
+            UPDATE vpn_jobs SET status = 'running'
+            WHERE id IN (
+                SELECT id FROM vpn_jobs WHERE status = 'pending' AND run_at <= ?
+                ORDER BY run_at LIMIT ?
+            )
+            RETURNING *
+            """,
+            (now, limit)
+        ) as cursor:
+            jobs = await cursor.fetchall()
+        await db.commit()
+        return sorted(jobs, key=lambda job: job['id'])
+
+@db_timed
+async def complete_jobs(job_ids: list):
+    if not job_ids:
+        return
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.execute(f"DELETE FROM vpn_jobs WHERE id IN ({_placeholders(job_ids)})", job_ids)
+        await db.commit()
+
+@db_timed
+async def reschedule_jobs(jobs: list):
+    # jobs: list of (status, attempts, run_at, last_error, id)
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        await db.executemany(
+            "UPDATE vpn_jobs SET status = ?, attempts = ?, run_at = ?, last_error = ? WHERE id = ?",
+            jobs
+        )
+        await db.commit()
+
+@db_timed
+async def release_running_jobs() -> int:
+    # Jobs claimed by a process that died are picked up again
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        cursor = await db.execute("UPDATE vpn_jobs SET status = 'pending' WHERE status = 'running'")
+        await db.commit()
+        return cursor.rowcount
+
+@db_timed
+async def retry_failed_jobs() -> int:
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        now = datetime.datetime.now().isoformat()
+        cursor = await db.execute(
+            "UPDATE OR IGNORE vpn_jobs SET status = 'pending', attempts = 0, run_at = ? WHERE status = 'failed'",
+            (now,)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+@db_timed
+async def count_jobs() -> dict:
+    # (kind, status) -> count
+    async with aiosqlite.connect(settings.DB_NAME) as db:
+        async with db.execute("SELECT kind, status, COUNT(*) FROM vpn_jobs GROUP BY kind, status") as cursor:
+            return {(kind, status): count for kind, status, count in await cursor.fetchall()}
@@ -1,10 +1,24 @@
 from aiogram import Router, F, types
 from aiogram.filters import Command, CommandObject
-from src.database import get_all_active_subs, update_subscription, get_user, get_user_key, save_key, disable_subscription, get_all_used_ips, get_all_active_keys
-from src.vpn_service import vpn_service
-from src.keyboards import admin_kb
+from aiogram.types import FSInputFile, BufferedInputFile
+from src.database import get_all_active_subs, update_subscription, get_user, get_user_key
+from src.database import get_referral_leaderboard, get_referral_tree
+from src.database import BULK_BATCH_SIZE, get_telegram_ids_by_filter, bulk_update_subscriptions, get_users_without_keys
+from src.access import revoke_access, provision_or_defer, create_keys_bulk, defer_provisioning
+from src.reconcile import reconcile
+from src.vpn_service import vpn_shards
+from src.catalog import get_catalog, load_catalog, set_price
+from src.audit import audit_log
+from src.database import get_user_history, count_jobs, retry_failed_jobs, search_users, count_user_keys
+from src.keyboards import admin_kb, user_search_kb, admin_user_kb, admin_confirm_disable_kb
+from src.backup import backup_now, restore, list_snapshots, find_snapshot
+from src.profiling import MAX_SECONDS, SamplingProfiler, memory_profile, profiling_lock, loop_lag_monitor
 from config import settings
+import datetime
 import logging
+import os
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -14,15 +28,26 @@ router = Router()
 def is_admin(telegram_id: int) -> bool:
     return telegram_id in settings.admin_ids_list
 
+QUEUED_REMOVAL_NOTE = "\n⚠️ VPN-интерфейс недоступен, пиры будут удалены автоматически (/jobs)."
+
+# /sync reconciles the interface with the DB, /sync dry only reports the differences
 @router.message(Command("sync"))
-async def cmd_sync(message: types.Message):
+async def cmd_sync(message: types.Message, command: CommandObject):
     if not is_admin(message.from_user.id): return
     
-    await message.answer("🔄 Начинаю синхронизацию VPN-интерфейса...")
+    dry_run = (command.args or "").strip() == "dry"
+    await message.answer("🔍 Сравниваю БД и VPN-интерфейс..." if dry_run else "🔄 Начинаю синхронизацию VPN-интерфейса...")
     try:
-        active_keys = await get_all_active_keys()
-        vpn_service.restore_peers(active_keys)
-        await message.answer(f"✅ Синхронизация завершена. Обработано {len(active_keys)} ключей.")
+        report = await reconcile(dry_run=dry_run)
+        audit_log.log(
+            "admin.sync", actor_id=message.from_user.id, dry_run=dry_run,
+            db_count=report.db_count, live_count=report.live_count,
+            to_add=len(report.to_add), to_remove=len(report.to_remove)
+        )
+        if report.in_sync:
+            await message.answer(f"✅ Интерфейс совпадает с БД ({report.db_count} ключей).")
+        else:
+            await message.answer(("📋 Отчет (без изменений):\n" if dry_run else "✅ Синхронизация завершена.\n") + report.summary())
     except Exception as e:
         logger.error(f"Sync failed: {e}")
         await message.answer(f"❌ Ошибка синхронизации: {e}")
@@ -33,6 +58,11 @@ async def cmd_admin(message: types.Message):
         return
     await message.answer("Админ-панель:", reply_markup=admin_kb())
 
+@router.callback_query(F.data == "admin_menu")
+async def cb_admin_menu(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    await callback.message.edit_text("Админ-панель:", reply_markup=admin_kb())
+
 @router.callback_query(F.data == "admin_stats")
 async def cb_admin_stats(callback: types.CallbackQuery):
     if not is_admin(callback.from_user.id): return
@@ -60,46 +90,45 @@ async def cmd_add_sub(message: types.Message, command: CommandObject):
         if not user:
             await message.answer("Пользователь не найден")
             return
-            
-        new_date = await update_subscription(target_id, days)
-        
-        # Check if user has a key, if not generate one
-        user_key = await get_user_key(user['id'])
-        if not user_key:
-            try:
-                priv, pub = vpn_service.generate_keys()
-                
-                # Proper IPAM
-                used_ips = await get_all_used_ips()
-                client_ip = vpn_service.get_next_ip(used_ips)
-                
-                server_pub = vpn_service.get_server_pubkey()
-                
-                vpn_service.add_peer(pub, client_ip)
-                
-                config_text = vpn_service.generate_client_config(priv, client_ip, server_pub)
-                
-                await save_key(user['id'], pub, priv, client_ip, config_text)
-                await message.answer("✅ Ключ VPN успешно сгенерирован для пользователя.")
-            except Exception as e:
-                logger.error(f"Failed to create VPN key in admin handler: {e}")
-                await message.answer("⚠️ Подписка продлена, но произошла ошибка при создании ключа.")
-
-        await message.answer(f"Подписка продлена до {new_date}")
+
+        await message.answer(await grant_subscription(user, days, message.from_user.id))
         
     except ValueError:
         await message.answer("Ошибка в аргументах")
 
+async def grant_subscription(user, days: int, admin_id: int) -> str:
+    """Extends a subscription and creates the first key if needed. Returns the report for the admin."""
+    target_id = user['telegram_id']
+    new_date = await update_subscription(target_id, days)
+    audit_log.log("admin.add_sub", target_id, admin_id, days=days, end_date=new_date)
+
+    # Check if user has a key, if not generate one
+    lines = []
+    user_key = await get_user_key(user['id'])
+    if not user_key:
+        if await provision_or_defer(user, reason=f"add_sub by admin {admin_id}"):
+            lines.append("✅ Ключ VPN успешно сгенерирован для пользователя.")
+        else:
+            lines.append("⚠️ VPN-интерфейс недоступен, ключ будет создан автоматически (/jobs).")
+    lines.append(f"Подписка продлена до {new_date}")
+    return "\n".join(lines)
+
 @router.callback_query(F.data == "admin_add_sub")
 async def cb_admin_add_sub(callback: types.CallbackQuery):
     if not is_admin(callback.from_user.id): return
-    await callback.message.answer("Для выдачи подписки используйте команду:\n/add_sub <telegram_id> <days>")
+    await callback.message.answer(
+        "Для выдачи подписки используйте команду:\n/add_sub <telegram_id> <days>\n\n"
+        "Массовое продление:\n/bulk_add_sub <days> <active|expired|all|id1,id2,...>"
+    )
     await callback.answer()
 
 @router.callback_query(F.data == "admin_disable_sub")
 async def cb_admin_disable_sub(callback: types.CallbackQuery):
     if not is_admin(callback.from_user.id): return
-    await callback.message.answer("Для отключения подписки используйте команду:\n/disable_sub <telegram_id>")
+    await callback.message.answer(
+        "Для отключения подписки используйте команду:\n/disable_sub <telegram_id>\n\n"
+        "Массовое отключение:\n/bulk_disable_sub <active|expired|all|id1,id2,...>"
+    )
     await callback.answer()
 
 @router.message(Command("disable_sub"))
@@ -118,9 +147,509 @@ async def cmd_disable_sub(message: types.Message, command: CommandObject):
         if not user:
             await message.answer("Пользователь не найден")
             return
-            
-        await disable_subscription(target_id)
-        await message.answer(f"Подписка пользователя {target_id} отключена.")
+
+        await message.answer(await disable_subscription(target_id, message.from_user.id))
         
     except ValueError:
         await message.answer("Ошибка в аргументах")
+
+async def disable_subscription(target_id: int, admin_id: int) -> str:
+    public_keys, removed = await revoke_access([target_id], reason=f"disabled by admin {admin_id}")
+    audit_log.log("admin.disable_sub", target_id, admin_id, revoked_keys=len(public_keys))
+    return f"Подписка пользователя {target_id} отключена. Отозвано ключей: {len(public_keys)}." + ("" if removed else QUEUED_REMOVAL_NOTE)
+
+# Bulk operations: /bulk_add_sub <days> <target>, /bulk_disable_sub <target>
+# target is a filter (active, expired, all) or a list of telegram_ids separated by spaces or commas
+
+BULK_FILTERS = ("active", "expired", "all")
+PROGRESS_INTERVAL = 2.0  # seconds between progress message edits
+
+async def resolve_bulk_targets(spec: list) -> list:
+    if len(spec) == 1 and spec[0] in BULK_FILTERS:
+        return await get_telegram_ids_by_filter(spec[0])
+    ids = []
+    for token in spec:
+        ids += [int(x) for x in token.split(",") if x]
+    # Deduplicate, keep order
+    return list(dict.fromkeys(ids))
+
+class ProgressReporter:
+    """Edits a single status message, throttled to avoid Telegram flood limits."""
+
+    def __init__(self, message: types.Message, title: str, total: int):
+        self.message = message
+        self.title = title
+        self.total = total
+        self.last_edit = 0.0
+
+    async def update(self, done: int, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_edit < PROGRESS_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await self.message.edit_text(f"⏳ {self.title}: {done} / {self.total}")
+        except Exception:
+            pass  # Message not modified or deleted
+
+@router.message(Command("bulk_add_sub"))
+async def cmd_bulk_add_sub(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = command.args.split() if command.args else []
+    if len(args) < 2:
+        await message.answer("Использование: /bulk_add_sub <days> <active|expired|all|id1,id2,...>")
+        return
+
+    try:
+        days = int(args[0])
+        targets = await resolve_bulk_targets(args[1:])
+    except ValueError:
+        await message.answer("Ошибка в аргументах")
+        return
+
+    if not targets:
+        await message.answer("Нет пользователей для обработки")
+        return
+
+    status = await message.answer(f"⏳ Продление подписок: 0 / {len(targets)}")
+    progress = ProgressReporter(status, "Продление подписок", len(targets))
+
+    updated = 0
+    keyless = []
+    for i in range(0, len(targets), BULK_BATCH_SIZE):
+        batch = targets[i:i + BULK_BATCH_SIZE]
+        updated += await bulk_update_subscriptions(batch, days)
+        for target_id in batch:
+            audit_log.log("admin.bulk_add_sub", target_id, message.from_user.id, days=days)
+        keyless += await get_users_without_keys(batch)
+        await progress.update(i + len(batch))
+    await progress.update(len(targets), force=True)
+
+    provisioned = []
+    if keyless:
+        try:
+            key_progress = ProgressReporter(status, "Создание ключей", len(keyless))
+            provisioned, error = await create_keys_bulk(keyless, key_progress.update)
+        except Exception as e:
+            error = e
+        if error:
+            # Like /add_sub: the users whose keys were not saved get them from the job queue
+            saved = {user['telegram_id'] for user in provisioned}
+            deferred = [user for user in keyless if user['telegram_id'] not in saved]
+            await defer_provisioning(deferred, f"bulk_add_sub by admin {message.from_user.id}")
+            logger.error(f"Failed to create {len(deferred)} VPN keys in bulk, queued for retry: {error}")
+            await message.answer(
+                f"⚠️ Подписки продлены, но создать ключи для {len(deferred)} пользователей не удалось. "
+                f"Они поставлены в очередь и будут созданы автоматически."
+            )
+
+    logger.info(f"Bulk add_sub by {message.from_user.id}: {updated} users, +{days} days, {len(provisioned)} keys")
+    await message.answer(f"✅ Подписки продлены на {days} дн.: {updated} пользователей. Создано ключей: {len(provisioned)}.")
+
+@router.message(Command("bulk_disable_sub"))
+async def cmd_bulk_disable_sub(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = command.args.split() if command.args else []
+    if not args:
+        await message.answer("Использование: /bulk_disable_sub <active|expired|all|id1,id2,...>")
+        return
+
+    try:
+        targets = await resolve_bulk_targets(args)
+    except ValueError:
+        await message.answer("Ошибка в аргументах")
+        return
+
+    if not targets:
+        await message.answer("Нет пользователей для обработки")
+        return
+
+    status = await message.answer(f"⏳ Отключение подписок: 0 / {len(targets)}")
+    progress = ProgressReporter(status, "Отключение подписок", len(targets))
+
+    public_keys, removed = await revoke_access(targets, reason=f"bulk disable by admin {message.from_user.id}", on_progress=progress.update)
+    await progress.update(len(targets), force=True)
+    for target_id in targets:
+        audit_log.log("admin.bulk_disable_sub", target_id, message.from_user.id)
+
+    await message.answer(f"✅ Отключено подписок: {len(targets)}. Отозвано ключей: {len(public_keys)}." + ("" if removed else QUEUED_REMOVAL_NOTE))
+
+# Catalog: /prices lists products, /set_price <payload> <price> changes a price without restart,
+# /reload_catalog picks up manual edits of the products table
+
+def format_catalog() -> str:
+    lines = ["🛒 Каталог:"]
+    for product in get_catalog().products:
+        state = "" if product.is_active else " (скрыт)"
+        lines.append(f"{product.payload}: {product.label} - {product.price}₽{state}")
+    return "\n".join(lines)
+
+@router.message(Command("prices"))
+async def cmd_prices(message: types.Message):
+    if not is_admin(message.from_user.id): return
+    await message.answer(format_catalog())
+
+@router.message(Command("set_price"))
+async def cmd_set_price(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = command.args.split() if command.args else []
+    if len(args) != 2:
+        await message.answer("Использование: /set_price <payload> <price>")
+        return
+
+    try:
+        price = int(args[1])
+        if price <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("Ошибка в аргументах")
+        return
+
+    if not await set_price(args[0], price):
+        await message.answer("Товар не найден")
+        return
+    audit_log.log("admin.set_price", actor_id=message.from_user.id, payload=args[0], price=price)
+    await message.answer("✅ Цена обновлена.\n" + format_catalog())
+
+@router.message(Command("reload_catalog"))
+async def cmd_reload_catalog(message: types.Message):
+    if not is_admin(message.from_user.id): return
+    await load_catalog()
+    await message.answer("✅ Каталог перезагружен.\n" + format_catalog())
+
+# Referrals: /ref_top [N] - leaderboard, /ref_tree <telegram_id> [depth] - who was invited by whom
+
+@router.message(Command("ref_top"))
+async def cmd_ref_top(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    try:
+        limit = int(command.args) if command.args else 10
+    except ValueError:
+        await message.answer("Использование: /ref_top [N]")
+        return
+
+    rows = await get_referral_leaderboard(min(max(limit, 1), 50))
+    if not rows:
+        await message.answer("Рефералов пока нет")
+        return
+    lines = ["🏆 Топ рефереров (прямые / вся сеть):"]
+    for place, row in enumerate(rows, start=1):
+        name = f"@{row['username']}" if row['username'] else row['referrer_id']
+        lines.append(f"{place}. {name} ({row['referrer_id']}): {row['direct']} / {row['network']}")
+    await message.answer("\n".join(lines))
+
+@router.message(Command("ref_tree"))
+async def cmd_ref_tree(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = command.args.split() if command.args else []
+    try:
+        target_id = int(args[0])
+        depth = int(args[1]) if len(args) > 1 else 3
+    except (IndexError, ValueError):
+        await message.answer("Использование: /ref_tree <telegram_id> [depth]")
+        return
+
+    rows = await get_referral_tree(target_id, min(max(depth, 1), 10))
+    if not rows:
+        await message.answer("Пользователь никого не пригласил")
+        return
+    lines = [f"🌳 Приглашенные пользователем {target_id} (✅ - купил подписку):"]
+    for row in rows:
+        name = f"@{row['username']}" if row['username'] else row['telegram_id']
+        lines.append(f"{'    ' * (row['depth'] - 1)}{'✅' if row['paid'] else '▫️'} {name} ({row['telegram_id']})")
+    await message.answer("\n".join(lines))
+
+# /history <telegram_id> [N] - latest audit events about a user or performed by them
+
+HISTORY_LIMIT = 20
+
+@router.message(Command("history"))
+async def cmd_history(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = command.args.split() if command.args else []
+    try:
+        target_id = int(args[0])
+        limit = int(args[1]) if len(args) > 1 else HISTORY_LIMIT
+    except (IndexError, ValueError):
+        await message.answer("Использование: /history <telegram_id> [N]")
+        return
+
+    # Buffered events would be missing from the query otherwise
+    await audit_log.flush()
+    rows = await get_user_history(target_id, min(max(limit, 1), 100))
+    if not rows:
+        await message.answer("Событий не найдено")
+        return
+    lines = [f"🗂 История пользователя {target_id}:"]
+    for row in rows:
+        actor = f" (by {row['actor_id']})" if row['actor_id'] and row['actor_id'] != row['telegram_id'] else ""
+        details = f" {row['details']}" if row['details'] else ""
+        lines.append(f"{row['created_at'][:19].replace('T', ' ')} {row['event']}{actor}{details}")
+    await message.answer("\n".join(lines))
+
+# /jobs - queued VPN provisioning work, /jobs retry - re-queue jobs that ran out of attempts
+
+JOB_STATUS_NAMES = {"pending": "в очереди", "running": "выполняется", "failed": "ошибка"}
+
+@router.message(Command("jobs"))
+async def cmd_jobs(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    if (command.args or "").strip() == "retry":
+        count = await retry_failed_jobs()
+        await message.answer(f"🔁 Перезапущено задач: {count}")
+        return
+
+    counts = await count_jobs()
+    lines = ["🧰 Очередь VPN-задач:"]
+    for (kind, status), count in sorted(counts.items()):
+        lines.append(f"{kind}: {JOB_STATUS_NAMES.get(status, status)} - {count}")
+    if not counts:
+        lines.append("пусто")
+    for shard, service in vpn_shards:
+        if service.breaker.is_open:
+            lines.append(f"⛔ {service.interface} недоступен, повтор через {service.breaker.retry_in:.0f} с")
+    await message.answer("\n".join(lines))
+
+# Bots can send documents up to 50 MB
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} МБ" if size >= 1024 * 1024 else f"{size / 1024:.0f} КБ"
+
+# /backup takes a snapshot and sends it, /backup list shows the stored snapshots
+@router.message(Command("backup"))
+async def cmd_backup(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    if (command.args or "").strip() == "list":
+        snapshots = list_snapshots()
+        lines = ["💾 Резервные копии:"] + [f"{os.path.basename(path)} - {format_size(os.path.getsize(path))}" for path in snapshots]
+        await message.answer("\n".join(lines) if snapshots else "Резервных копий нет.")
+        return
+
+    await message.answer("💾 Создаю резервную копию...")
+    try:
+        path = await backup_now()
+    except Exception as e:
+        logger.error(f"Backup failed: {e}")
+        await message.answer(f"❌ Ошибка резервного копирования: {e}")
+        return
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    audit_log.log("admin.backup", actor_id=message.from_user.id, file=name, size=size)
+    if size > MAX_DOCUMENT_SIZE:
+        await message.answer(f"✅ Копия {name} ({format_size(size)}) сохранена на сервере, она слишком большая для отправки.")
+        return
+    await message.answer_document(FSInputFile(path, filename=name), caption=f"✅ {name}, {format_size(size)}")
+
+# /restore <file> confirm replaces the DB with a snapshot from /backup list
+@router.message(Command("restore"))
+async def cmd_restore(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    args = (command.args or "").split()
+    path = find_snapshot(args[0]) if args else None
+    if path is None:
+        await message.answer("Использование: /restore <файл> confirm\nСписок копий: /backup list")
+        return
+    if args[1:] != ["confirm"]:
+        await message.answer(
+            f"⚠️ Все данные будут заменены копией {args[0]}, изменения после нее будут потеряны "
+            f"(текущее состояние сохранится отдельной копией).\nПодтвердите: /restore {args[0]} confirm"
+        )
+        return
+
+    await message.answer("♻️ Проверяю копию и восстанавливаю БД...")
+    try:
+        previous = await restore(path)
+    except Exception as e:
+        logger.error(f"Restore failed: {e}")
+        await message.answer(f"❌ Восстановление не выполнено: {e}")
+        return
+    audit_log.log("admin.restore", actor_id=message.from_user.id, file=args[0], previous=os.path.basename(previous))
+    await load_catalog()
+    # Keys in the restored DB differ from the peers on the interface
+    try:
+        report = await reconcile()
+        sync_text = f"Интерфейс синхронизирован: +{len(report.to_add)} -{len(report.to_remove)} пиров."
+    except Exception as e:
+        logger.error(f"Sync after restore failed: {e}")
+        sync_text = f"⚠️ Синхронизация интерфейса не удалась ({e}), выполните /sync."
+    await message.answer(f"✅ БД восстановлена из {args[0]}.\nПредыдущее состояние: {os.path.basename(previous)}\n{sync_text}")
+
+def parse_profile_args(args: str, default_seconds: int = 10, default_top: int = 15) -> tuple:
+    parts = (args or "").split()
+    seconds = int(parts[0]) if parts and parts[0].isdigit() else default_seconds
+    top = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else default_top
+    return max(1, min(seconds, MAX_SECONDS)), max(1, min(top, 50))
+
+# /profile [seconds] [top] samples all threads and sends the top functions plus a flamegraph file
+@router.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+    if profiling_lock.locked():
+        await message.answer("⏳ Профилирование уже запущено.")
+        return
+
+    seconds, top = parse_profile_args(command.args)
+    async with profiling_lock:
+        await message.answer(f"🔬 Профилирую {seconds} с...")
+        report = await SamplingProfiler().profile(seconds)
+    audit_log.log("admin.profile", actor_id=message.from_user.id, seconds=seconds, samples=report.samples)
+    # Long labels do not fit into one message with a large top
+    await message.answer(report.summary(top)[:4000])
+    name = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+    await message.answer_document(
+        BufferedInputFile(report.folded().encode(), filename=name),
+        caption="Стеки в формате flamegraph.pl / speedscope"
+    )
+
+# /memprofile [seconds] [top] traces allocations with tracemalloc
+@router.message(Command("memprofile"))
+async def cmd_memprofile(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+    if profiling_lock.locked():
+        await message.answer("⏳ Профилирование уже запущено.")
+        return
+
+    seconds, top = parse_profile_args(command.args)
+    async with profiling_lock:
+        await message.answer(f"🧠 Отслеживаю выделения памяти {seconds} с...")
+        summary = await memory_profile(seconds, top)
+    audit_log.log("admin.memprofile", actor_id=message.from_user.id, seconds=seconds)
+    await message.answer(summary[:4000])
+
+# /lag shows the latest event loop stalls caught by the lag monitor
+@router.message(Command("lag"))
+async def cmd_lag(message: types.Message):
+    if not is_admin(message.from_user.id): return
+    if not settings.LOOP_LAG_THRESHOLD_MS:
+        await message.answer("Монитор задержек выключен (LOOP_LAG_THRESHOLD_MS=0).")
+        return
+    if not loop_lag_monitor.recent:
+        await message.answer(f"✅ Блокировок цикла событий дольше {settings.LOOP_LAG_THRESHOLD_MS} мс не было.")
+        return
+    lines = [f"🐢 Блокировки цикла событий (порог {settings.LOOP_LAG_THRESHOLD_MS} мс):"]
+    for at, seconds, handler, culprit in reversed(loop_lag_monitor.recent):
+        lines.append(f"{at:%d.%m %H:%M:%S} {seconds * 1000:.0f} мс\n  обработчик: {handler}\n  место: {culprit}")
+    await message.answer("\n".join(lines)[:4000])
+
+# User browser: /users [@username prefix | telegram_id], pages are keyset-paginated by search_users
+
+USERS_PAGE_SIZE = 10
+USER_QUERY = re.compile(r"@?([A-Za-z0-9_]{1,32})")
+
+def is_active_sub(end_date) -> bool:
+    return bool(end_date) and datetime.datetime.fromisoformat(end_date) > datetime.datetime.now()
+
+async def render_user_page(query: str, cursor_id: int = None, backward: bool = False) -> tuple:
+    rows, has_more = await search_users(query, cursor_id, backward, USERS_PAGE_SIZE)
+    if not rows:
+        return ("🔎 Никого не найдено." if query else "🔎 Пользователей нет."), user_search_kb([], query, False, False)
+    users = [
+        {"id": row['id'], "telegram_id": row['telegram_id'], "username": row['username'],
+         "is_active": is_active_sub(row['subscription_end_date'])}
+        for row in rows
+    ]
+    if cursor_id is None:
+        has_prev, has_next = False, has_more
+    elif backward:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = True, has_more
+    title = f"🔎 Поиск «{query}»:" if query else "👥 Пользователи (новые сверху):"
+    return title, user_search_kb(users, query, has_prev, has_next)
+
+@router.message(Command("users"))
+async def cmd_users(message: types.Message, command: CommandObject):
+    if not is_admin(message.from_user.id): return
+
+    query = ""
+    if command.args:
+        match = USER_QUERY.fullmatch(command.args.strip())
+        if not match:
+            await message.answer("Использование: /users [@username или его начало | telegram_id]")
+            return
+        query = match.group(1)
+    text, markup = await render_user_page(query)
+    await message.answer(text, reply_markup=markup)
+
+@router.callback_query(F.data == "admin_users")
+async def cb_admin_users(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    text, markup = await render_user_page("")
+    await callback.message.edit_text(text + "\nПоиск: /users <username или id>", reply_markup=markup)
+
+@router.callback_query(F.data.startswith("adm_users:"))
+async def cb_admin_users_page(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    _, direction, cursor_id, query = callback.data.split(":", 3)
+    text, markup = await render_user_page(query, int(cursor_id), backward=direction == "p")
+    await callback.message.edit_text(text, reply_markup=markup)
+
+async def user_card(telegram_id: int):
+    user = await get_user(telegram_id)
+    if not user:
+        return None
+    end = user['subscription_end_date']
+    if is_active_sub(end):
+        sub = f"активна до {datetime.datetime.fromisoformat(end):%d.%m.%Y %H:%M}"
+    else:
+        sub = "нет" if not end else f"истекла {datetime.datetime.fromisoformat(end):%d.%m.%Y}"
+    devices = await count_user_keys(user['id'])
+    lines = [
+        f"👤 {('@' + user['username']) if user['username'] else 'без username'}",
+        f"ID: {user['telegram_id']}",
+        f"Подписка: {sub}",
+        f"Устройства: {devices}/{user['max_devices']}",
+        f"Регистрация: {user['created_at']}",
+    ]
+    if user['referrer_id']:
+        lines.append(f"Пригласил: {user['referrer_id']}")
+    return "\n".join(lines)
+
+@router.callback_query(F.data.startswith("adm_user:"))
+async def cb_admin_user(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    telegram_id = int(callback.data.split(":")[1])
+    card = await user_card(telegram_id)
+    if card is None:
+        await callback.answer("Пользователь не найден", show_alert=True)
+        return
+    await callback.message.edit_text(card, reply_markup=admin_user_kb(telegram_id))
+
+@router.callback_query(F.data.startswith("adm_user_add:"))
+async def cb_admin_user_add(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    _, telegram_id, days = callback.data.split(":")
+    user = await get_user(int(telegram_id))
+    if not user:
+        await callback.answer("Пользователь не найден", show_alert=True)
+        return
+    await callback.answer()
+    report = await grant_subscription(user, int(days), callback.from_user.id)
+    await callback.message.edit_text(f"{await user_card(user['telegram_id'])}\n\n{report}", reply_markup=admin_user_kb(user['telegram_id']))
+
+@router.callback_query(F.data.startswith("adm_user_off:"))
+async def cb_admin_user_off(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    telegram_id = int(callback.data.split(":")[1])
+    await callback.message.edit_text(
+        f"Отключить подписку пользователя {telegram_id} и удалить его ключи?",
+        reply_markup=admin_confirm_disable_kb(telegram_id)
+    )
+
+@router.callback_query(F.data.startswith("adm_user_off_ok:"))
+async def cb_admin_user_off_ok(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id): return
+    telegram_id = int(callback.data.split(":")[1])
+    await callback.answer()
+    report = await disable_subscription(telegram_id, callback.from_user.id)
+    await callback.message.edit_text(f"{await user_card(telegram_id)}\n\n{report}", reply_markup=admin_user_kb(telegram_id))
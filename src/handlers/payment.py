@@ -1,7 +1,9 @@
 from aiogram import Router, F, types
 from aiogram.types import LabeledPrice, PreCheckoutQuery
-from src.database import get_user, update_subscription, add_referral_count, reset_referral_count, save_key, get_user_key, increment_max_devices, get_all_used_ips
-from src.vpn_service import vpn_service
+from src.database import get_user, update_subscription, record_referral, get_user_key, increment_max_devices
+from src.access import provision_or_defer, reshape_user
+from src.catalog import SLOT, get_catalog
+from src.audit import audit_log
 from src.keyboards import buy_sub_kb, main_menu_kb
 from config import settings
 import logging
@@ -13,60 +15,30 @@ logger = logging.getLogger(__name__)
 async def cb_buy_sub(callback: types.CallbackQuery):
     await callback.message.edit_text("Выберите тариф:", reply_markup=buy_sub_kb())
 
-@router.callback_query(F.data == "buy_slot")
-async def cb_buy_slot(callback: types.CallbackQuery):
-    price = 100 # 100 RUB per slot
-    title = "Дополнительный слот"
-    description = "Дополнительное устройство для VPN"
-    payload = "buy_slot"
-    
-    await callback.message.answer_invoice(
-        title=title,
-        description=description,
-        payload=payload,
-        provider_token=settings.PAYMENT_TOKEN,
-        currency="RUB",
-        prices=[LabeledPrice(label=title, amount=price * 100)],
-        start_parameter="create_invoice_slot"
-    )
-
+# Covers subscription plans (buy_<code>) and the extra slot (buy_slot)
 @router.callback_query(F.data.startswith("buy_"))
 async def cb_process_buy(callback: types.CallbackQuery):
-    plan = callback.data.split("_")[1]
-    
-    price = 0
-    title = ""
-    description = ""
-    payload = ""
-    
-    if plan == "1":
-        price = settings.PRICE_1_MONTH
-        title = "VPN - 1 Месяц"
-        description = "Доступ к VPN на 30 дней"
-        payload = "sub_30"
-    elif plan == "3":
-        price = settings.PRICE_3_MONTHS
-        title = "VPN - 3 Месяца"
-        description = "Доступ к VPN на 90 дней"
-        payload = "sub_90"
-    elif plan == "12":
-        price = settings.PRICE_12_MONTHS
-        title = "VPN - 1 Год"
-        description = "Доступ к VPN на 365 дней"
-        payload = "sub_365"
-        
+    product = get_catalog().by_code.get(callback.data[len("buy_"):])
+    if not product or not product.is_active:
+        await callback.answer("Тариф недоступен", show_alert=True)
+        return
+
     await callback.message.answer_invoice(
-        title=title,
-        description=description,
-        payload=payload,
+        title=product.title,
+        description=product.description,
+        payload=product.payload,
         provider_token=settings.PAYMENT_TOKEN,
         currency="RUB",
-        prices=[LabeledPrice(label=title, amount=price * 100)], # Amount in kopecks
-        start_parameter="create_invoice_vpn_sub"
+        prices=[LabeledPrice(label=product.title, amount=product.price * 100)], # Amount in kopecks
+        start_parameter="create_invoice_slot" if product.kind == SLOT else "create_invoice_vpn_sub"
     )
 
 @router.pre_checkout_query()
 async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
+    # Hidden products are still accepted: the invoice may have been issued before
+    if pre_checkout_query.invoice_payload not in get_catalog().by_payload:
+        await pre_checkout_query.answer(ok=False, error_message="Тариф больше недоступен")
+        return
     await pre_checkout_query.answer(ok=True)
 
 @router.message(F.successful_payment)
@@ -75,68 +47,47 @@ async def process_successful_payment(message: types.Message):
     payload = payment_info.invoice_payload
     telegram_id = message.from_user.id
     
-    if payload == "buy_slot":
+    audit_log.log(
+        "payment", telegram_id, telegram_id,
+        payload=payload, amount=payment_info.total_amount, currency=payment_info.currency,
+        telegram_charge_id=payment_info.telegram_payment_charge_id,
+        provider_charge_id=payment_info.provider_payment_charge_id
+    )
+    product = get_catalog().by_payload.get(payload)
+    if product is None:
+        logger.error(f"Payment from {telegram_id} with unknown payload {payload}")
+        await message.answer("Оплата прошла, но тариф не найден. Обратитесь в поддержку.")
+        return
+
+    if product.kind == SLOT:
         await increment_max_devices(telegram_id)
         await message.answer("✅ Слот успешно куплен! Теперь вы можете добавить еще одно устройство.", reply_markup=main_menu_kb())
         return
-    
-    days = 0
-    if payload == "sub_30":
-        days = 30
-    elif payload == "sub_90":
-        days = 90
-    elif payload == "sub_365":
-        days = 365
         
     # 1. Update Subscription
-    new_end_date = await update_subscription(telegram_id, days)
+    new_end_date = await update_subscription(telegram_id, product.days, product.payload)
     
     # 2. Manage VPN Key
     user = await get_user(telegram_id)
     existing_key = await get_user_key(user['id'])
     
+    key_ready = True
     if not existing_key:
-        try:
-            # Generate new key
-            priv, pub = vpn_service.generate_keys()
-            
-            # Proper IPAM
-            used_ips = await get_all_used_ips()
-            client_ip = vpn_service.get_next_ip(used_ips)
-            
-            server_pub = vpn_service.get_server_pubkey()
-            
-            vpn_service.add_peer(pub, client_ip)
-            
-            config_text = vpn_service.generate_client_config(priv, client_ip, server_pub)
-            
-            await save_key(user['id'], pub, priv, client_ip, config_text)
-            
-        except Exception as e:
-            logger.error(f"Failed to create VPN key: {e}")
-            await message.answer("Оплата прошла, но произошла ошибка при создании ключа. Обратитесь в поддержку.")
-            return
+        # If the VPN interface is down the key is created by a background job later
+        key_ready = await provision_or_defer(user, reason="payment")
+    else:
+        # The plan may have changed, and with it the bandwidth class
+        await reshape_user(user)
 
-    # 3. Referral Logic
-    referrer_id = user['referrer_id']
-    if referrer_id:
-        # Check if this is the first purchase (or just count every purchase? Requirement says "received month of sub")
-        # Requirement: "Referral counts if he received month of sub (paid or invited 3 friends)"
-        # We simply increment the counter for the referrer.
-        
-        # To prevent abuse, we might want to check if we already counted this user.
-        # But for now, let's assume simple logic:
-        await add_referral_count(referrer_id)
-        
-        referrer = await get_user(referrer_id)
-        if referrer and referrer['referral_count'] >= settings.REF_REWARD_THRESHOLD:
-            # Give reward
-            await update_subscription(referrer['telegram_id'], settings.REF_REWARD_DAYS)
-            await reset_referral_count(referrer['telegram_id'])
-            
+    # 3. Referral rewards: each referee counts once per referrer, repeat purchases are ignored
+    if user['referrer_id']:
+        grants = await record_referral(telegram_id, settings.referral_levels)
+        for referrer_id, days in grants:
+            audit_log.log("referral.reward", referrer_id, referee_id=telegram_id, days=days)
             try:
-                await message.bot.send_message(referrer['telegram_id'], f"🎉 Поздравляем! Вы пригласили {settings.REF_REWARD_THRESHOLD} друзей и получили {settings.REF_REWARD_DAYS} дней подписки бесплатно!")
+                await message.bot.send_message(referrer_id, f"🎉 Поздравляем! Ваши приглашенные друзья оформили подписку, и вы получили {days} дней подписки бесплатно!")
             except:
                 pass # User might have blocked bot
 
-    await message.answer(f"✅ Оплата прошла успешно! Подписка продлена до {new_end_date.strftime('%d.%m.%Y')}.\nВаш ключ доступен в Профиле.", reply_markup=main_menu_kb())
+    key_text = "Ваш ключ доступен в Профиле." if key_ready else "Ключ будет создан автоматически в течение нескольких минут, мы пришлем уведомление."
+    await message.answer(f"✅ Оплата прошла успешно! Подписка продлена до {new_end_date.strftime('%d.%m.%Y')}.\n{key_text}", reply_markup=main_menu_kb())
@@ -1,12 +1,14 @@
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart, CommandObject
-from src.database import create_user, get_user, get_user_key, get_user_keys, count_user_keys, save_key, deactivate_key, get_all_used_ips, delete_key_by_id
+from src.database import create_user, get_user, delete_key_by_id, get_referral_stats
+from src.loaders import load_profile, load_devices, load_key
 from src.keyboards import main_menu_kb, profile_kb, back_kb, devices_kb, device_actions_kb
-from src.vpn_service import vpn_service
+from src.vpn_service import peer_restorer, vpn_shards, peer_shard
+from src.access import create_key, remove_peers_or_defer
+from src.audit import audit_log
 from config import settings
 import datetime
 import os
-import qrcode
 import io
 import logging
 import re
@@ -16,6 +18,21 @@ logger = logging.getLogger(__name__)
 def sanitize_filename(name: str) -> str:
     return re.sub(r'[^\w\-]', '_', name)
 
+def render_qr_png(data: str) -> bytes:
+    # qrcode pulls in PIL, import it on first use to keep startup fast
+    import qrcode
+
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    # Save to buffer
+    bio = io.BytesIO()
+    img.save(bio)
+    return bio.getvalue()
+
 router = Router()
 
 @router.message(CommandStart())
@@ -43,7 +60,7 @@ async def cb_main_menu(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "profile")
 async def cb_profile(callback: types.CallbackQuery):
-    user = await get_user(callback.from_user.id)
+    user = await load_profile(callback.from_user.id)
     sub_end = user['subscription_end_date']
     
     has_sub = False
@@ -65,26 +82,29 @@ async def cb_profile(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "referrals")
 async def cb_referrals(callback: types.CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    count = user['referral_count']
+    # Only the ID is needed, no user row
+    telegram_id = callback.from_user.id
+    stats = await get_referral_stats(telegram_id)
     needed = settings.REF_REWARD_THRESHOLD
     
     bot_username = (await callback.bot.get_me()).username
-    ref_link = f"https://t.me/{bot_username}?start={user['telegram_id']}"
+    ref_link = f"https://t.me/{bot_username}?start={telegram_id}"
     
     text = (
         f"👥 <b>Реферальная программа</b>\n\n"
         f"Приглашайте друзей и получайте бесплатную подписку!\n"
         f"Условия: {needed} друга, купивших подписку = {settings.REF_REWARD_DAYS} дней бесплатно.\n\n"
         f"Ваша ссылка:\n<code>{ref_link}</code>\n\n"
-        f"Приглашено активных: {count}/{needed}"
+        f"Приглашено активных: {stats['pending']}/{needed}\n"
+        f"Всего купили подписку: {stats['direct']}"
     )
+    if len(settings.referral_levels) > 1:
+        text += f"\nВ вашей сети (все уровни): {stats['network']}"
     await callback.message.edit_text(text, reply_markup=back_kb(), parse_mode="HTML")
 
 @router.callback_query(F.data == "my_devices")
 async def cb_my_devices(callback: types.CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    keys = await get_user_keys(user['id'])
+    user, keys = await load_devices(callback.from_user.id)
     
     can_add = len(keys) < user['max_devices']
     
@@ -98,28 +118,17 @@ async def cb_my_devices(callback: types.CallbackQuery):
 
 @router.callback_query(F.data == "add_device")
 async def cb_add_device(callback: types.CallbackQuery):
-    user = await get_user(callback.from_user.id)
-    current_count = await count_user_keys(user['id'])
+    user = await load_profile(callback.from_user.id)
+    current_count = user['key_count']
     
     if current_count >= user['max_devices']:
         await callback.answer("Достигнут лимит устройств!", show_alert=True)
         return
 
     try:
-        priv, pub = vpn_service.generate_keys()
-        
-        # Proper IPAM
-        used_ips = await get_all_used_ips()
-        client_ip = vpn_service.get_next_ip(used_ips)
-        
-        server_pub = vpn_service.get_server_pubkey()
-        
-        vpn_service.add_peer(pub, client_ip)
-        
-        config_text = vpn_service.generate_client_config(priv, client_ip, server_pub)
-        
         device_name = f"Device {current_count + 1}"
-        await save_key(user['id'], pub, priv, client_ip, config_text, device_name)
+        public_key = await create_key(user, device_name)
+        audit_log.log("device.add", user['telegram_id'], user['telegram_id'], device_name=device_name, public_key=public_key)
         
         await callback.answer("Устройство добавлено!", show_alert=True)
         await cb_my_devices(callback)
@@ -137,12 +146,13 @@ async def cb_device_actions(callback: types.CallbackQuery):
 @router.callback_query(F.data.startswith("delete_device_"))
 async def cb_delete_device(callback: types.CallbackQuery):
     device_id = int(callback.data.split("_")[2])
-    user = await get_user(callback.from_user.id)
+    user = await load_profile(callback.from_user.id)
     
     try:
-        public_key = await delete_key_by_id(device_id, user['id'])
-        if public_key:
-            vpn_service.remove_peer(public_key)
+        key = await delete_key_by_id(device_id, user['id'])
+        if key:
+            audit_log.log("device.delete", user['telegram_id'], user['telegram_id'], key_id=device_id, public_key=key['public_key'])
+            await remove_peers_or_defer([key], user['telegram_id'])
             await callback.answer("Устройство удалено!", show_alert=True)
             await cb_my_devices(callback)
         else:
@@ -152,21 +162,22 @@ async def cb_delete_device(callback: types.CallbackQuery):
         await callback.answer("Ошибка при удалении устройства.", show_alert=True)
 
 async def get_valid_key_data_by_id(callback: types.CallbackQuery, key_id: int):
-    user_id = callback.from_user.id
-    user = await get_user(user_id)
-    
-    if not user['subscription_end_date'] or datetime.datetime.fromisoformat(user['subscription_end_date']) < datetime.datetime.now():
+    # Subscription, key and ownership check in one query
+    target_key = await load_key(callback.from_user.id, key_id)
+    if target_key is None:
+        await callback.answer("Ключ не найден.", show_alert=True)
+        return None
+
+    if not target_key['subscription_end_date'] or datetime.datetime.fromisoformat(target_key['subscription_end_date']) < datetime.datetime.now():
         await callback.answer("Подписка истекла!", show_alert=True)
         return None
 
-    # Get specific key
-    keys = await get_user_keys(user['id'])
-    target_key = next((k for k in keys if k['id'] == key_id), None)
-    
-    if not target_key:
+    if target_key['id'] is None:
         await callback.answer("Ключ не найден.", show_alert=True)
         return None
-        
+
+    # Right after a restart the peer may still be queued for restore
+    await peer_restorer.ensure([target_key])
     return target_key
 
 @router.callback_query(F.data.startswith("key_file_"))
@@ -210,19 +221,10 @@ async def cb_key_qr(callback: types.CallbackQuery):
     config_content = key_data['config']
     
     # Generate QR
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(config_content)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save to buffer
-    bio = io.BytesIO()
-    img.save(bio)
-    bio.seek(0)
+    png = render_qr_png(config_content)
     
     await callback.message.answer_photo(
-        types.BufferedInputFile(bio.getvalue(), filename="qrcode.png"),
+        types.BufferedInputFile(png, filename="qrcode.png"),
         caption="Отсканируйте этот QR-код в приложении AmneziaWG (не Amnezia VPN!)."
     )
     await callback.answer()
@@ -248,6 +250,9 @@ async def cb_key_amnezia_app(callback: types.CallbackQuery):
         
         logger.info(f"Generating Amnezia VPN config for device: {key_data['device_name']}")
         
+        # Every shard listens on its own port
+        server_port = vpn_shards[peer_shard(key_data)].server_port
+        
         awg_params = {
             "Jc": str(settings.AMNEZIA_JC),
             "Jmin": str(settings.AMNEZIA_JMIN),
@@ -273,7 +278,7 @@ async def cb_key_amnezia_app(callback: types.CallbackQuery):
         last_config_obj = {
             "config": config_content,
             "hostName": settings.VPN_HOST,
-            "port": str(settings.VPN_PORT),
+            "port": str(server_port),
             "mtu": 1420,
             **awg_params
         }
@@ -289,7 +294,7 @@ async def cb_key_amnezia_app(callback: types.CallbackQuery):
         
         awg_block = {
             "hostName": settings.VPN_HOST,
-            "port": str(settings.VPN_PORT),
+            "port": str(server_port),
             "transport_proto": "udp",
             **awg_params,
             "last_config": json.dumps(last_config_obj, separators=(',', ':'))
@@ -323,17 +328,10 @@ async def cb_key_amnezia_app(callback: types.CallbackQuery):
         logger.info(f"Generated VPN link: {vpn_link[:50]}...")
         
         # Generate QR for the link
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(vpn_link)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        bio = io.BytesIO()
-        img.save(bio)
-        bio.seek(0)
+        png = render_qr_png(vpn_link)
         
         await callback.message.answer_photo(
-            types.BufferedInputFile(bio.getvalue(), filename="amnezia_qr.png"),
+            types.BufferedInputFile(png, filename="amnezia_qr.png"),
             caption="Отсканируйте этот QR-код в основном приложении **Amnezia VPN**.\n\n"
                 "Если QR-код не сканируется, попробуйте импортировать **текстовый ключ** (кнопка '📝 Текст').\n"
                 "Если подключение есть, но нет значка VPN: проверьте Настройки -> VPN на iPhone.",
@@ -0,0 +1,163 @@
+"""
+Durable queue of VPN interface work that could not be done inline.
+
+provision   - create the first key of a user who paid (or got a subscription from an admin)
+deprovision - remove peers whose keys are already deactivated in the DB
+
+Jobs live in the vpn_jobs table, so they survive restarts. Workers claim due jobs in
+batches and apply each batch in bulk: all removals of a shard in one awg call, all
+provisioning through create_keys_bulk. A failed job is retried with exponential backoff.
+While a shard's circuit breaker is open its jobs wait for the breaker instead of
+burning attempts, and the backlog drains in bulk as soon as the probe succeeds.
+"""
+from src.database import (
+    BULK_BATCH_SIZE, claim_jobs, complete_jobs, reschedule_jobs, release_running_jobs, count_jobs, get_users_without_keys,
+)
+from src.access import create_keys_bulk
+from src.audit import audit_log
+from src.circuit import CircuitOpen
+from src.notifier import notification_sender
+from src.keyboards import main_menu_kb
+from src.vpn_service import vpn_shards
+from src.tenants import TenantLocal
+from config import settings
+import asyncio
+import datetime
+import json
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5.0  # seconds between looks at the queue when it is idle
+# A batch's ids are bound as parameters (get_users_without_keys, complete_jobs)
+CLAIM_BATCH_SIZE = BULK_BATCH_SIZE
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff with +-20% jitter, capped at JOB_BACKOFF_MAX_SECONDS."""
+    delay = min(settings.JOB_BACKOFF_MAX_SECONDS, settings.JOB_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+class JobQueue:
+    def __init__(self, workers: int = None):
+        self.workers = workers or settings.JOB_WORKERS
+        self.bot = None
+        self.tasks = []
+        self.depth = 0
+        self._stopping = False
+        self._wakeup = None
+
+    async def _sleep(self, seconds: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def start(self, bot):
+        self.bot = bot
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        released = await release_running_jobs()
+        if released:
+            logger.info(f"Re-queued {released} VPN jobs interrupted by a restart")
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        """Stops claiming new jobs and waits for the current batches; unfinished ones are re-queued on start."""
+        self._stopping = True
+        if self._wakeup:
+            self._wakeup.set()
+        if self.tasks:
+            done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        self.tasks = []
+
+    async def _worker(self):
+        while not self._stopping:
+            try:
+                jobs = await claim_jobs(CLAIM_BATCH_SIZE)
+                self.depth = sum(count for (_, status), count in (await count_jobs()).items() if status != "failed")
+                if not jobs:
+                    await self._sleep(POLL_INTERVAL)
+                    continue
+                await self.process(jobs)
+            except Exception as e:
+                logger.error(f"VPN job worker error: {e}")
+                await self._sleep(POLL_INTERVAL)
+
+    async def process(self, jobs: list):
+        provision = [job for job in jobs if job['kind'] == "provision"]
+        deprovision = [job for job in jobs if job['kind'] == "deprovision"]
+        by_shard = {}
+        for job in deprovision:
+            by_shard.setdefault(json.loads(job['payload'])['shard'], []).append(job)
+        await asyncio.gather(
+            self._provision(provision),
+            *(self._deprovision(shard, shard_jobs) for shard, shard_jobs in by_shard.items())
+        )
+
+    async def _deprovision(self, shard: int, jobs: list):
+        payloads = [json.loads(job['payload']) for job in jobs]
+        public_keys = [key for payload in payloads for key in payload['public_keys']]
+        # Jobs queued by older versions carry no addresses
+        ip_addresses = [ip for payload in payloads for ip in payload.get('ip_addresses', [])]
+        try:
+            await asyncio.to_thread(vpn_shards[shard].remove_peers, public_keys, ip_addresses)
+        except Exception as e:
+            await self._retry(jobs, e, vpn_shards[shard].breaker)
+            return
+        await complete_jobs([job['id'] for job in jobs])
+        logger.info(f"Removed {len(public_keys)} queued peers from {vpn_shards[shard].interface}")
+
+    async def _provision(self, jobs: list):
+        if not jobs:
+            return
+        # Users who got a key in the meantime (e.g. via /add_sub) are done already, and so are
+        # users whose subscription was revoked (/disable_sub) or ran out while the job waited
+        users = await get_users_without_keys([job['telegram_id'] for job in jobs])
+        try:
+            provisioned, error = await create_keys_bulk(users) if users else ([], None)
+        except Exception as e:
+            await self._retry(jobs, e)
+            return
+        # Shards are saved one by one: only the users of the shards that failed are retried
+        failed = {user['telegram_id'] for user in users} - {user['telegram_id'] for user in provisioned}
+        await complete_jobs([job['id'] for job in jobs if job['telegram_id'] not in failed])
+        if failed:
+            await self._retry([job for job in jobs if job['telegram_id'] in failed], error)
+
+        for user in provisioned:
+            audit_log.log("key.provisioned", user['telegram_id'], reason="queued")
+            await notification_sender.send(
+                self.bot, user['telegram_id'],
+                "✅ Ваш VPN-ключ готов! Он доступен в Профиле.",
+                kind="provisioned", reply_markup=main_menu_kb()
+            )
+
+    async def _retry(self, jobs: list, error: Exception, breaker=None):
+        now = datetime.datetime.now()
+        if breaker:
+            retry_in = breaker.retry_in
+        else:
+            # Provisioning may land on any shard
+            retry_in = min(service.breaker.retry_in for _, service in vpn_shards)
+        retry_in = max(retry_in, settings.JOB_BACKOFF_SECONDS)
+        updates = []
+        for job in jobs:
+            if isinstance(error, CircuitOpen):
+                # The interface is known to be down: wait for the breaker, keep the attempt count
+                updates.append(("pending", job['attempts'], (now + datetime.timedelta(seconds=retry_in)).isoformat(), str(error), job['id']))
+                continue
+            attempts = job['attempts'] + 1
+            if attempts >= settings.JOB_MAX_ATTEMPTS:
+                logger.error(f"VPN job {job['id']} ({job['kind']}) failed after {attempts} attempts: {error}")
+                audit_log.log("job.failed", job['telegram_id'], job_id=job['id'], kind=job['kind'], error=str(error))
+                updates.append(("failed", attempts, now.isoformat(), str(error), job['id']))
+            else:
+                run_at = now + datetime.timedelta(seconds=backoff_delay(attempts))
+                updates.append(("pending", attempts, run_at.isoformat(), str(error), job['id']))
+        await reschedule_jobs(updates)
+        logger.warning(f"{len(jobs)} VPN jobs rescheduled: {error}")
+
+job_queue = TenantLocal(JobQueue)
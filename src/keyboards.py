@@ -1,7 +1,16 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import settings
+from src.catalog import Catalog, get_catalog
+from src.metrics import export_lru_cache
+import functools
 
-def main_menu_kb():
+# Markups are built once and shared between calls: handlers only pass them to the Bot API
+# and must not modify them in place.
+
+DEVICE_ACTIONS_CACHE_SIZE = 4096
+DEVICES_CACHE_SIZE = 4096
+BUY_SUB_CACHE_SIZE = 32  # one catalog per tenant
+
+def _build_main_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👤 Профиль", callback_data="profile")],
         [InlineKeyboardButton(text="💳 Купить подписку", callback_data="buy_sub")],
@@ -9,39 +18,38 @@ def main_menu_kb():
         [InlineKeyboardButton(text="🆘 Поддержка", callback_data="support")]
     ])
 
-def buy_sub_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"1 Месяц - {settings.PRICE_1_MONTH}₽", callback_data="buy_1")],
-        [InlineKeyboardButton(text=f"3 Месяца - {settings.PRICE_3_MONTHS}₽", callback_data="buy_3")],
-        [InlineKeyboardButton(text=f"1 Год - {settings.PRICE_12_MONTHS}₽", callback_data="buy_12")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
+def _build_buy_sub_kb(catalog: Catalog):
+    buttons = [
+        [InlineKeyboardButton(text=f"{product.label} - {product.price}₽", callback_data=f"buy_{product.code}")]
+        for product in catalog.subscriptions
+    ]
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def profile_kb(has_active_sub: bool):
+def _build_profile_kb(has_active_sub: bool):
     buttons = []
     if has_active_sub:
         buttons.append([InlineKeyboardButton(text="📱 Мои устройства", callback_data="my_devices")])
         buttons.append([InlineKeyboardButton(text="📖 Инструкция", callback_data="instruction")])
-    
+
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def devices_kb(devices: list, can_add: bool):
+def _build_devices_kb(devices: tuple, can_add: bool):
+    # devices: tuple of (id, device_name)
     buttons = []
-    for i, device in enumerate(devices):
-        # device is a Row object or dict, assuming it has 'id' and 'device_name'
-        name = device['device_name']
-        buttons.append([InlineKeyboardButton(text=f"📱 {name}", callback_data=f"device_{device['id']}")])
-    
+    for device_id, name in devices:
+        buttons.append([InlineKeyboardButton(text=f"📱 {name}", callback_data=f"device_{device_id}")])
+
     if can_add:
         buttons.append([InlineKeyboardButton(text="➕ Добавить устройство", callback_data="add_device")])
     else:
         buttons.append([InlineKeyboardButton(text="🔒 Купить слот (+1)", callback_data="buy_slot")])
-        
+
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="profile")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def device_actions_kb(device_id: int):
+def _build_device_actions_kb(device_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📄 Файл", callback_data=f"key_file_{device_id}")],
         [InlineKeyboardButton(text="📝 Текст", callback_data=f"key_text_{device_id}")],
@@ -51,15 +59,98 @@ def device_actions_kb(device_id: int):
         [InlineKeyboardButton(text="🔙 Назад", callback_data="my_devices")]
     ])
 
-def back_kb():
+def _build_renew_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Продлить подписку", callback_data="buy_sub")]
+    ])
+
+def _build_back_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
     ])
 
-def admin_kb():
+def _build_admin_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="➕ Выдать подписку", callback_data="admin_add_sub")],
         [InlineKeyboardButton(text="❌ Отключить подписку", callback_data="admin_disable_sub")],
+        [InlineKeyboardButton(text="🔎 Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
     ])
+
+# Static keyboards
+MAIN_MENU_KB = _build_main_menu_kb()
+BACK_KB = _build_back_kb()
+RENEW_KB = _build_renew_kb()
+ADMIN_KB = _build_admin_kb()
+PROFILE_KBS = {True: _build_profile_kb(True), False: _build_profile_kb(False)}
+
+# Parameterized keyboards. buy_sub_kb is keyed by the Catalog object, so a reload misses the cache.
+_cached_buy_sub_kb = functools.lru_cache(maxsize=BUY_SUB_CACHE_SIZE)(_build_buy_sub_kb)
+_cached_devices_kb = functools.lru_cache(maxsize=DEVICES_CACHE_SIZE)(_build_devices_kb)
+_cached_device_actions_kb = functools.lru_cache(maxsize=DEVICE_ACTIONS_CACHE_SIZE)(_build_device_actions_kb)
+export_lru_cache("buy_sub_kb", _cached_buy_sub_kb)
+export_lru_cache("devices_kb", _cached_devices_kb)
+export_lru_cache("device_actions_kb", _cached_device_actions_kb)
+
+def main_menu_kb():
+    return MAIN_MENU_KB
+
+def buy_sub_kb():
+    return _cached_buy_sub_kb(get_catalog())
+
+def profile_kb(has_active_sub: bool):
+    return PROFILE_KBS[bool(has_active_sub)]
+
+def devices_kb(devices: list, can_add: bool):
+    # device is a Row object or dict with 'id' and 'device_name'
+    return _cached_devices_kb(tuple((device['id'], device['device_name']) for device in devices), bool(can_add))
+
+def device_actions_kb(device_id: int):
+    return _cached_device_actions_kb(int(device_id))
+
+def back_kb():
+    return BACK_KB
+
+def renew_kb():
+    return RENEW_KB
+
+def admin_kb():
+    return ADMIN_KB
+
+# Admin user browser. Built per call: pages differ every time and only admins see them.
+# Callback data stays under Telegram's 64 bytes: the query is at most 32 characters.
+
+ADMIN_QUICK_ADD_DAYS = (7, 30)
+
+def user_search_kb(users: list, query: str, has_prev: bool, has_next: bool):
+    # users: rows with id, telegram_id, username, is_active
+    buttons = []
+    for user in users:
+        name = f"@{user['username']}" if user['username'] else "без username"
+        mark = "✅" if user['is_active'] else "▫️"
+        buttons.append([InlineKeyboardButton(text=f"{mark} {name} · {user['telegram_id']}", callback_data=f"adm_user:{user['telegram_id']}")])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"adm_users:p:{users[0]['id']}:{query}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"adm_users:n:{users[-1]['id']}:{query}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def admin_user_kb(telegram_id: int):
+    buttons = [[
+        InlineKeyboardButton(text=f"➕ {days} дн.", callback_data=f"adm_user_add:{telegram_id}:{days}")
+        for days in ADMIN_QUICK_ADD_DAYS
+    ]]
+    buttons.append([InlineKeyboardButton(text="❌ Отключить подписку", callback_data=f"adm_user_off:{telegram_id}")])
+    buttons.append([InlineKeyboardButton(text="🔙 К списку", callback_data="admin_users")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def admin_confirm_disable_kb(telegram_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Да, отключить", callback_data=f"adm_user_off_ok:{telegram_id}")],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"adm_user:{telegram_id}")],
+    ])
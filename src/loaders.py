@@ -0,0 +1,72 @@
+"""
+View loaders: one query per screen instead of chained get_user / get_user_keys / count calls.
+
+Loads issued in the same event loop tick are batched into one query (telegram_id IN (...))
+and deduplicated, so a burst of clicks from many users costs a few round-trips, and a
+handler that loads the same view twice in one update shares the query. Nothing is cached
+past the batch: a load issued after a write always sees it.
+"""
+from src.database import BULK_BATCH_SIZE, get_profile_views, get_devices_views, get_key_views
+from src.tenants import TenantLocal
+import asyncio
+
+class BatchLoader:
+    def __init__(self, batch_fn, max_batch: int = BULK_BATCH_SIZE):
+        # batch_fn: coroutine function list of keys -> dict key -> value (missing keys load as None)
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self._pending = {}
+        self._tasks = set()
+
+    async def load(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                # Runs after the callbacks already queued, i.e. after every update of this tick had its say
+                loop.call_soon(self._dispatch)
+            future = self._pending[key] = loop.create_future()
+        # Shielded: a cancelled caller must not cancel the load for the others waiting on it
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        batch, self._pending = self._pending, {}
+        keys = list(batch)
+        for i in range(0, len(keys), self.max_batch):
+            chunk = {key: batch[key] for key in keys[i:i + self.max_batch]}
+            task = asyncio.create_task(self._run(chunk))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: dict):
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+# Per tenant: a batch is one query against one tenant's database
+profile_loader = TenantLocal(lambda: BatchLoader(get_profile_views))
+devices_loader = TenantLocal(lambda: BatchLoader(get_devices_views))
+# A (telegram_id, key_id) pair takes two bind parameters
+key_loader = TenantLocal(lambda: BatchLoader(get_key_views, max_batch=BULK_BATCH_SIZE // 2))
+
+async def load_profile(telegram_id: int):
+    """users row plus key_count, None for unknown users."""
+    return await profile_loader.load(telegram_id)
+
+async def load_devices(telegram_id: int) -> tuple:
+    """(user, active keys) for the devices screen; (None, []) for unknown users."""
+    return await devices_loader.load(telegram_id) or (None, [])
+
+async def load_key(telegram_id: int, key_id: int):
+    """
+    One key with an ownership check: the row has the owner's subscription_end_date and the
+    key columns, which are NULL if the key is not theirs. None for unknown users.
+    """
+    return await key_loader.load((telegram_id, key_id))
@@ -0,0 +1,282 @@
+"""
+Minimal Prometheus-style metrics: counters, gauges and histograms exposed in the
+text exposition format over a local HTTP endpoint (GET /metrics).
+
+Recording a sample is a dict lookup plus a few additions, so it is safe to use on
+the hot path. No external dependencies besides aiohttp, which aiogram already ships.
+"""
+from abc import ABC, abstractmethod
+import bisect
+import functools
+import inspect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value) -> str:
+    # Label values may come from users, the text format needs \\, \" and \n escaped
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._functions = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """A fresh value holder for one label combination."""
+
+    def set_function(self, fn, *values):
+        """Evaluates fn() at scrape time, e.g. for queue depths or the hit counts of an lru_cache."""
+        self._functions[values] = fn
+
+    def collect(self) -> list:
+        for values, fn in self._functions.items():
+            try:
+                self.labels(*values).set(fn())
+            except Exception as e:
+                logger.debug(f"Metric {self.name}{values} callback failed: {e}")
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self._children.items()):
+            lines += child.render(self.name, self.labelnames, values)
+        return lines
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {self.value}"]
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_format_labels(labelnames, values, le)} {cumulative}")
+        inf = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_format_labels(labelnames, values, inf)} {self.count}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {self.sum}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {self.count}")
+        return lines
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.collect()
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Core metrics
+
+HANDLER_LATENCY = registry.register(Histogram(
+    "bot_handler_duration_seconds", "Update handler latency by route", ("route",)
+))
+HANDLER_ERRORS = registry.register(Counter(
+    "bot_handler_errors_total", "Update handlers that raised, by route", ("route",)
+))
+DB_QUERY_LATENCY = registry.register(Histogram(
+    "bot_db_query_duration_seconds", "Time spent in src.database functions", ("function",)
+))
+VPN_COMMAND_LATENCY = registry.register(Histogram(
+    "bot_vpn_command_duration_seconds", "awg/ip subprocess time by VpnService method", ("method",)
+))
+VPN_COMMAND_FAILURES = registry.register(Counter(
+    "bot_vpn_command_failures_total", "Failed VpnService calls by method", ("method",)
+))
+SCHEDULER_RUN_LATENCY = registry.register(Histogram(
+    "bot_scheduler_run_duration_seconds", "Scheduled job run time", ("job",),
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0)
+))
+QUEUE_DEPTH = registry.register(Gauge(
+    "bot_queue_depth", "Pending items per internal queue", ("queue",)
+))
+THROTTLED = registry.register(Counter(
+    "bot_throttled_total", "Callback queries rejected by the throttling middleware", ("route", "reason")
+))
+CACHE_REQUESTS = registry.register(Counter(
+    "bot_cache_requests_total", "Cache lookups by cache and result (hit/miss)", ("cache", "result")
+))
+CIRCUIT_OPEN = registry.register(Gauge(
+    "bot_circuit_open", "1 while the circuit breaker of an interface is open", ("interface",)
+))
+NOTIFICATIONS = registry.register(Counter(
+    "bot_notifications_total", "Messages sent by background jobs, by kind and result", ("kind", "result")
+))
+EVENT_LOOP_STALLS = registry.register(Histogram(
+    "bot_event_loop_stall_seconds", "Periods the event loop was blocked longer than LOOP_LAG_THRESHOLD_MS",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+))
+
+STARTUP_PHASES = registry.register(Gauge(
+    "bot_startup_phase_seconds", "Duration of each startup phase", ("phase",)
+))
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+def export_lru_cache(cache: str, fn):
+    """Reports the hits and misses of a functools.lru_cache wrapper as CACHE_REQUESTS, read at scrape time."""
+    CACHE_REQUESTS.set_function(lambda: fn.cache_info().hits, cache, "hit")
+    CACHE_REQUESTS.set_function(lambda: fn.cache_info().misses, cache, "miss")
+
+def timed(histogram: Histogram, label: str, failures: Counter = None):
+    """Decorator recording call duration (and optionally failures) for sync or async functions."""
+    def decorator(fn):
+        child = histogram.labels(label)
+        fail_child = failures.labels(label) if failures else None
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    if fail_child:
+                        fail_child.inc()
+                    raise
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if fail_child:
+                    fail_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class PhaseTimer:
+    """Measures consecutive phases (startup steps) and exports them as STARTUP_PHASES."""
+
+    def __init__(self, started: float = None):
+        self.started = started if started is not None else time.perf_counter()
+        self.last = self.started
+        self.phases = []
+
+    def record(self, phase: str, seconds: float):
+        self.phases.append((phase, seconds))
+        STARTUP_PHASES.labels(phase).set(seconds)
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.record(phase, now - self.last)
+        self.last = now
+
+    def summary(self) -> str:
+        parts = [f"{phase} {seconds:.3f}s" for phase, seconds in self.phases]
+        return ", ".join(parts) + f" (total {self.last - self.started:.3f}s)"
+
+def db_timed(fn):
+    return timed(DB_QUERY_LATENCY, fn.__name__)(fn)
+
+def vpn_timed(fn):
+    return timed(VPN_COMMAND_LATENCY, fn.__name__, VPN_COMMAND_FAILURES)(fn)
+
+async def start_metrics_server(host: str, port: int):
+    """Serves GET /metrics. Returns the aiohttp runner so the caller can clean it up."""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,215 @@
+from aiogram import BaseMiddleware
+from aiogram.filters import Command
+from aiogram.types import CallbackQuery, Message
+from config import settings, use_settings
+from src.tenants import TenantLocal
+from src.metrics import HANDLER_LATENCY, HANDLER_ERRORS, THROTTLED, record_cache
+import asyncio
+import re
+import time
+
+# Ids are stripped from callback data so key_qr_42 and key_qr_43 share one route label,
+# and so are ":"-separated arguments (adm_user:42, adm_users:n:17:query)
+_ID_SUFFIX = re.compile(r"_\d+$")
+# Callback data is client-controlled: labels are capped per handler (route_label)
+MAX_ROUTES_PER_HANDLER = 10
+ROUTE_CACHE_SIZE = 2000
+
+_route_cache = {}
+# Commands of the Command filters of the routers, see register_commands()
+_commands = set()
+# handler callback -> route labels it has reported
+_handler_routes = {}
+
+def register_commands(*routers):
+    """Collects the commands the routers handle, so route_of() can tell them from made-up ones."""
+    for router in routers:
+        for nested in router.chain_tail:
+            for handler in nested.message.handlers:
+                for filter_object in handler.filters or ():
+                    if isinstance(filter_object.callback, Command):
+                        _commands.update(f"/{c}" for c in filter_object.callback.commands if isinstance(c, str))
+
+def route_of(event) -> str:
+    if isinstance(event, CallbackQuery):
+        data = event.data or ""
+        route = _route_cache.get(data)
+        record_cache("route", route is not None)
+        if route is None:
+            route = _ID_SUFFIX.sub("", data.split(":", 1)[0])
+            if len(_route_cache) < ROUTE_CACHE_SIZE:
+                _route_cache[data] = route
+        return route
+    if isinstance(event, Message):
+        if event.successful_payment:
+            return "successful_payment"
+        if event.text and event.text.startswith("/"):
+            command = event.text.split()[0].split("@")[0]
+            # Any text can start with "/", only known commands become labels
+            return command if command in _commands else "command"
+        return "message"
+    return type(event).__name__
+
+def route_label(event, data: dict) -> str:
+    """
+    route_of() for metric labels. Inner middlewares only see events a handler accepted, and
+    each handler reports at most MAX_ROUTES_PER_HANDLER routes: crafted callback data that
+    passes a prefix filter (device_xyz) fills the quota of that handler only, the routes of
+    every other handler keep their labels.
+    """
+    label = data.get("route_label")
+    if label is not None:
+        # Already resolved by an earlier middleware for this event
+        return label
+    route = label = route_of(event)
+    handler = data.get("handler")
+    routes = _handler_routes.setdefault(handler.callback if handler else None, set())
+    if route not in routes:
+        if len(routes) >= MAX_ROUTES_PER_HANDLER:
+            label = "other"
+        else:
+            routes.add(route)
+    data["route"], data["route_label"] = route, label
+    return label
+
+class TenantMiddleware(BaseMiddleware):
+    """Handles every update in the context of the tenant that owns the bot it came to (src/tenants.py)."""
+
+    def __init__(self, tenants: list):
+        self.by_bot_id = {tenant.bot.id: tenant.settings for tenant in tenants}
+
+    async def __call__(self, handler, event, data):
+        tenant_settings = self.by_bot_id.get(data["bot"].id)
+        if tenant_settings is None:
+            return await handler(event, data)
+        with use_settings(tenant_settings):
+            return await handler(event, data)
+
+class InFlightMiddleware(BaseMiddleware):
+    """Counts updates being handled so a graceful shutdown can wait for them."""
+
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records handler latency and errors per route."""
+
+    async def __call__(self, handler, event, data):
+        route = route_label(event, data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(route).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(route).observe(time.perf_counter() - start)
+
+# Extra per-route limits for CPU-heavy buttons: route -> (burst, tokens per second)
+ROUTE_LIMITS = {
+    "key_qr": (3, 0.2),
+    "key_amnezia_app": (3, 0.2),
+    "key_file": (3, 0.2),
+    "key_text": (5, 0.5),
+    "add_device": (2, 0.1),
+    "delete_device": (3, 0.2),
+    "buy_slot": (3, 0.2),
+}
+# Buckets untouched for this long are full again and can be forgotten
+BUCKET_TTL = 300.0
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Token-bucket limits per user and per (user, route) for callback queries, per bot.
+    Identical callbacks (same user, same data) that arrive while the first one is
+    still being handled are coalesced: they only get a cheap callback.answer.
+    """
+
+    def __init__(self, rate: float = None, burst: int = None, route_limits: dict = None):
+        self.rate = rate if rate is not None else settings.RATE_LIMIT_PER_SECOND
+        self.burst = burst if burst is not None else settings.RATE_LIMIT_BURST
+        self.route_limits = ROUTE_LIMITS if route_limits is None else route_limits
+        # Admins of the tenant the update came to
+        self.exempt = TenantLocal(lambda: set(settings.admin_ids_list))
+        self.buckets = {}
+        self.in_flight = set()
+        self.last_sweep = time.monotonic()
+
+    def _take(self, key, rate: float, burst: float, now: float) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(burst, now)
+        return bucket.take(rate, burst, now)
+
+    def _sweep(self, now: float):
+        self.buckets = {k: b for k, b in self.buckets.items() if now - b.updated < BUCKET_TTL}
+        self.last_sweep = now
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        user_id = event.from_user.id
+        if user_id in self.exempt:
+            return await handler(event, data)
+
+        # Limits go by route, metrics by the capped label: callback data is client-controlled
+        label = route_label(event, data)
+        route = data["route"]
+        # One instance serves every tenant: a user of two bots has separate limits in each
+        bot_id = data["bot"].id
+        key = (bot_id, user_id, event.data)
+        if key in self.in_flight:
+            THROTTLED.labels(label, "coalesced").inc()
+            await event.answer("⏳ Уже обрабатывается...")
+            return None
+
+        now = time.monotonic()
+        if now - self.last_sweep > BUCKET_TTL:
+            self._sweep(now)
+
+        allowed = self._take((bot_id, user_id), self.rate, self.burst, now)
+        if allowed and route in self.route_limits:
+            route_burst, route_rate = self.route_limits[route]
+            allowed = self._take((bot_id, user_id, route), route_rate, route_burst, now)
+        if not allowed:
+            THROTTLED.labels(label, "rate_limited").inc()
+            await event.answer("Слишком много запросов, подождите немного.")
+            return None
+
+        self.in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(key)
@@ -0,0 +1,51 @@
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from src.metrics import NOTIFICATIONS
+from src.tenants import TenantLocal
+from config import settings
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class RateLimitedSender:
+    """
+    Sends messages from background jobs at no more than `rate` per second across all
+    callers. Sends overlap (the next one starts before the previous answered), only their
+    start times are paced. A RetryAfter from Telegram pauses every sender.
+    """
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / (rate or settings.NOTIFY_RATE_PER_SECOND)
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    async def _wait_slot(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.paused_until)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send(self, bot, chat_id: int, text: str, kind: str = "message", **kwargs) -> bool:
+        for attempt in range(2):
+            await self._wait_slot()
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                NOTIFICATIONS.labels(kind, "sent").inc()
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control, pausing notifications for {e.retry_after}s")
+                self.paused_until = time.monotonic() + e.retry_after
+            except (TelegramForbiddenError, TelegramBadRequest):
+                # Blocked the bot or deleted the account
+                NOTIFICATIONS.labels(kind, "blocked").inc()
+                return False
+            except Exception as e:
+                logger.error(f"Failed to send {kind} to {chat_id}: {e}")
+                break
+        NOTIFICATIONS.labels(kind, "failed").inc()
+        return False
+
+# Telegram limits messages per bot, so each tenant has its own pace
+notification_sender = TenantLocal(RateLimitedSender)
@@ -0,0 +1,230 @@
+"""
+On-demand diagnostics for a running bot, no restart needed.
+
+SamplingProfiler  - a thread that samples the stacks of all other threads every few ms;
+                    cheap enough to run in production, reports where time is spent
+                    (event loop and the awg/render worker threads alike)
+memory_profile    - tracemalloc snapshots before and after a window, reports the lines
+                    whose allocations grew the most
+LoopLagMonitor    - a watchdog thread that notices when the event loop stops ticking and
+                    captures the stack of whatever is blocking it
+"""
+from src.metrics import EVENT_LOOP_STALLS
+from config import settings
+from collections import Counter, deque
+import asyncio
+import datetime
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005  # seconds
+MAX_SECONDS = 300
+TRACEMALLOC_FRAMES = 10
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# One profiling session at a time
+profiling_lock = asyncio.Lock()
+
+def _short_path(filename: str) -> str:
+    if filename.startswith(ROOT):
+        return os.path.relpath(filename, ROOT)
+    # Keep the package name of library frames: .../site-packages/aiogram/x.py -> aiogram/x.py
+    parts = filename.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+def _frame_label(code, lineno: int) -> str:
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{lineno})"
+
+def _stack(frame) -> tuple:
+    """Frame labels from the outermost call to frame."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(labels))
+
+class ProfileReport:
+    def __init__(self, stacks: Counter, samples: int, seconds: float):
+        self.stacks = stacks
+        self.samples = samples
+        self.seconds = seconds
+
+    def top(self, n: int) -> tuple:
+        """(self time, cumulative time) top-n lists of (label, share of samples)."""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        samples = sum(self.stacks.values()) or 1
+        return (
+            [(label, count / samples) for label, count in own.most_common(n)],
+            [(label, count / samples) for label, count in total.most_common(n)],
+        )
+
+    def folded(self) -> str:
+        """Collapsed stacks ("a;b;c count" per line), the input format of flamegraph.pl and speedscope."""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, n: int) -> str:
+        own, total = self.top(n)
+        lines = [f"Профиль за {self.seconds:.0f} с: {self.samples} замеров"]
+        lines.append("\nСобственное время:")
+        lines += [f"{share:6.1%}  {label}" for label, share in own]
+        lines.append("\nС учетом вызовов:")
+        lines += [f"{share:6.1%}  {label}" for label, share in total]
+        return "\n".join(lines)
+
+class SamplingProfiler:
+    """Samples all threads except its own. Idle threads (waiting in select or a queue) are skipped."""
+
+    IDLE = {"select", "poll", "epoll", "wait", "_worker", "_connection_worker_thread"}
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = _stack(frame)
+            if not stack or stack[-1].split(" ", 1)[0] in self.IDLE:
+                continue
+            self.stacks[stack] += 1
+        self.samples += 1
+
+    def _run(self, seconds: float, loop, done: asyncio.Future):
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline and not self._stop.wait(self.interval):
+                self._sample()
+        finally:
+            # Not joined from a worker thread, which would show up in every sample
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+    async def profile(self, seconds: float) -> ProfileReport:
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        thread = threading.Thread(target=self._run, args=(seconds, loop, done), name="sampling-profiler", daemon=True)
+        thread.start()
+        try:
+            await done
+        except asyncio.CancelledError:
+            self._stop.set()
+            raise
+        return ProfileReport(self.stacks, self.samples, time.monotonic() - started)
+
+def _snapshot_diff(before, after) -> list:
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, linecache.__file__)]
+    return after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+
+async def memory_profile(seconds: float, top: int) -> str:
+    """Traces allocations for `seconds` and reports the top lines by growth, plus current and peak usage."""
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    try:
+        # Snapshots of a big heap take a while, keep them off the event loop
+        before = await asyncio.to_thread(tracemalloc.take_snapshot)
+        await asyncio.sleep(seconds)
+        after = await asyncio.to_thread(tracemalloc.take_snapshot)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    diff = await asyncio.to_thread(_snapshot_diff, before, after)
+    lines = [
+        f"Память за {seconds:.0f} с: отслеживается {current / 1024 / 1024:.1f} МБ, пик {peak / 1024 / 1024:.1f} МБ",
+        "\nРост по строкам:",
+    ]
+    for stat in diff[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size_diff / 1024:+9.1f} КБ ({stat.count_diff:+d})  "
+            f"{_short_path(frame.filename)}:{frame.lineno}  всего {stat.size / 1024:.1f} КБ"
+        )
+    if not was_tracing:
+        lines.append("\nУчитываются только выделения за время замера.")
+    return "\n".join(lines)
+
+class LoopLagMonitor:
+    """
+    The event loop bumps a heartbeat every `interval`; a watchdog thread checks it. Once the
+    heartbeat is `threshold` late, the loop thread is blocked by synchronous code, and its
+    stack, taken right then, shows the culprit. When the loop comes back, the stall is logged
+    with its duration, the handler it happened in and the blocking line.
+    """
+
+    def __init__(self, threshold_ms: int, interval: float = 0.05, history: int = 20):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.recent = deque(maxlen=history)
+        self.heartbeat = 0.0
+        self.task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stop.clear()
+        self.task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        stalled_since = None
+        stack = ()
+        while not self._stop.wait(self.interval):
+            beat = self.heartbeat
+            late = time.monotonic() - beat - self.interval
+            if stalled_since is None and late >= self.threshold:
+                stalled_since = beat
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = _stack(frame) if frame else ()
+            elif stalled_since is not None and beat != stalled_since:
+                self._report(beat - stalled_since - self.interval, stack)
+                stalled_since = None
+
+    def _report(self, seconds: float, stack: tuple):
+        EVENT_LOOP_STALLS.observe(seconds)
+        # The handler is the innermost frame in src/handlers, the culprit the innermost frame of our code
+        handler = next((label for label in reversed(stack) if "src/handlers/" in label), "-")
+        culprit = next((label for label in reversed(stack) if "(src/" in label), stack[-1] if stack else "-")
+        self.recent.append((datetime.datetime.now(), seconds, handler, culprit))
+        logger.warning(
+            f"Event loop blocked for {seconds * 1000:.0f} ms, handler: {handler}, at: {culprit}\n"
+            + "\n".join(f"  {label}" for label in stack[-15:])
+        )
+
+loop_lag_monitor = LoopLagMonitor(settings.LOOP_LAG_THRESHOLD_MS)
@@ -0,0 +1,104 @@
+from src.database import get_all_active_keys, get_active_key_shards
+from src.vpn_service import vpn_shards, peer_addresses, peer_plan, group_by_shard
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Keys listed per category in the admin report
+REPORT_SAMPLE_SIZE = 10
+
+class ReconcileReport:
+    def __init__(self, db_count: int, live_count: int, to_add: list, to_remove: list, dry_run: bool):
+        self.db_count = db_count
+        self.live_count = live_count
+        self.to_add = to_add
+        self.to_remove = to_remove
+        self.dry_run = dry_run
+
+    @property
+    def in_sync(self) -> bool:
+        return not self.to_add and not self.to_remove
+
+    def summary(self) -> str:
+        action = "Будет" if self.dry_run else "Выполнено"
+        lines = [
+            f"Ключей в БД: {self.db_count}, пиров на интерфейсе: {self.live_count}",
+            f"{action}: добавить {len(self.to_add)}, удалить {len(self.to_remove)}",
+        ]
+        for title, keys in (("➕", self.to_add), ("➖", self.to_remove)):
+            for key in keys[:REPORT_SAMPLE_SIZE]:
+                lines.append(f"{title} {key[:16]}...")
+            if len(keys) > REPORT_SAMPLE_SIZE:
+                lines.append(f"{title} ... и еще {len(keys) - REPORT_SAMPLE_SIZE}")
+        return "\n".join(lines)
+
+def diff_peers(expected: dict, live) -> tuple:
+    """
+    Hash join of expected peers (public_key -> frozenset of allowed-ips) against the
+    live (public_key, allowed_ips) stream. Single pass over each side.
+    Returns (to_add, to_remove, live_count); to_add includes peers with wrong allowed-ips.
+    """
+    to_add = []
+    to_remove = []
+    seen = set()
+    live_count = 0
+    for public_key, allowed in live:
+        live_count += 1
+        want = expected.get(public_key)
+        if want is None:
+            to_remove.append(public_key)
+            continue
+        seen.add(public_key)
+        if allowed != want:
+            to_add.append(public_key)
+    to_add += [key for key in expected if key not in seen]
+    return to_add, to_remove, live_count
+
+def _diff_interface(service, expected: dict) -> tuple:
+    if not service.check_interface():
+        raise Exception(f"Interface {service.interface} does not exist or is down.")
+    return diff_peers(expected, service.iter_peers())
+
+def _apply(service, to_add: list, to_remove: list, addresses: dict, plans: dict):
+    if to_remove:
+        # Stray peers have no address in the DB; their class is replaced when the address is reused
+        service.remove_peers(to_remove)
+    if to_add:
+        service.add_peers([(key, *addresses[key], plans[key]) for key in to_add])
+
+async def reconcile_shard(shard: int, keys: list, dry_run: bool = False) -> ReconcileReport:
+    service = vpn_shards[shard]
+    addresses = {key['public_key']: peer_addresses(key) for key in keys}
+    plans = {key['public_key']: peer_plan(key) for key in keys}
+    expected = {public_key: frozenset(service.allowed_ips(*ips)) for public_key, ips in addresses.items()}
+
+    to_add, to_remove, live_count = await asyncio.to_thread(_diff_interface, service, expected)
+    if not dry_run:
+        # A recreated interface (awg-quick down/up) comes back without its qdiscs. On an intact
+        # tree this is a no-op: replacing the htb root with the same handle keeps its classes
+        await asyncio.to_thread(service.setup_shaping)
+    if not dry_run and (to_add or to_remove):
+        # Keys added, expired or revoked by handlers since the snapshot must not be undone
+        active = await get_active_key_shards(to_add + to_remove)
+        to_add = [key for key in to_add if active.get(key) == shard]
+        to_remove = [key for key in to_remove if active.get(key) != shard]
+        await asyncio.to_thread(_apply, service, to_add, to_remove, addresses, plans)
+    if to_add or to_remove:
+        logger.info(f"Reconcile {service.interface}{' (dry run)' if dry_run else ''}: +{len(to_add)} -{len(to_remove)} peers")
+    return ReconcileReport(len(expected), live_count, to_add, to_remove, dry_run)
+
+async def reconcile(dry_run: bool = False) -> ReconcileReport:
+    """Makes every interface match the active keys in the DB: adds missing peers, removes stray ones."""
+    groups = group_by_shard(await get_all_active_keys())
+    # Shards run in parallel; a shard without keys is still checked for stray peers
+    reports = await asyncio.gather(*(
+        reconcile_shard(shard, groups.get(shard, []), dry_run) for shard, _ in vpn_shards
+    ))
+    return ReconcileReport(
+        sum(r.db_count for r in reports),
+        sum(r.live_count for r in reports),
+        [key for r in reports for key in r.to_add],
+        [key for r in reports for key in r.to_remove],
+        dry_run,
+    )
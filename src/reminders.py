@@ -0,0 +1,57 @@
+from src.database import BULK_BATCH_SIZE, get_reminder_batch, save_sent_reminders, delete_sent_reminders_before
+from src.keyboards import renew_kb
+from src.notifier import notification_sender
+from config import settings
+import asyncio
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+def reminder_text(end_date: datetime.datetime) -> str:
+    return (
+        f"⏳ Ваша подписка заканчивается {end_date.strftime('%d.%m.%Y в %H:%M')}.\n"
+        f"Продлите ее, чтобы не потерять доступ к VPN."
+    )
+
+async def send_expiry_reminders(bot, offsets: list = None, sender=None, batch_size: int = BULK_BATCH_SIZE) -> int:
+    """
+    Sends one reminder per user and subscription end for each offset (seconds before the end).
+    Offsets split the time ahead into windows: a subscription ending within (previous offset, offset]
+    from now gets the `offset` reminder, so a user who is already close to the end only receives
+    the nearest one. Each window is an indexed range scan read in keyset batches.
+    Returns the number of reminders sent.
+    """
+    offsets = sorted(offsets if offsets is not None else settings.reminder_offsets)
+    sender = sender or notification_sender
+    now = datetime.datetime.now()
+    start = now.isoformat()
+    sent = 0
+
+    await delete_sent_reminders_before(start)
+    for offset in offsets:
+        end = (now + datetime.timedelta(seconds=offset)).isoformat()
+        after = None
+        while True:
+            rows = await get_reminder_batch(start, end, offset, after, batch_size)
+            if not rows:
+                break
+            after = (rows[-1]['subscription_end_date'], rows[-1]['telegram_id'])
+            # Claimed before sending: a crash mid-batch skips a reminder rather than repeating it
+            await save_sent_reminders([(row['subscription_end_date'], row['telegram_id'], offset) for row in rows])
+            results = await asyncio.gather(*(
+                sender.send(
+                    bot, row['telegram_id'],
+                    reminder_text(datetime.datetime.fromisoformat(row['subscription_end_date'])),
+                    kind="expiry_reminder", reply_markup=renew_kb()
+                )
+                for row in rows
+            ))
+            sent += sum(results)
+            if len(rows) < batch_size:
+                break
+        start = end
+
+    if sent:
+        logger.info(f"Sent {sent} expiry reminders")
+    return sent
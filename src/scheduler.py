@@ -1,37 +1,151 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from src.database import get_expired_subs, deactivate_key
-from src.vpn_service import vpn_service
+from src.database import get_expired_subs, deactivate_keys
+from src.vpn_service import vpn_shards, peer_restorer, group_by_shard
+from src.metrics import timed, SCHEDULER_RUN_LATENCY
+from src.reconcile import reconcile
+from src.reminders import send_expiry_reminders
+from src.notifier import notification_sender
+from src.keyboards import renew_kb
+from src.audit import audit_log
+from src.backup import backup_now
+from src.tenants import in_tenant
+import asyncio
+import functools
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Tasks of scheduled jobs that are currently running, awaited on shutdown
+_running_jobs = set()
+
+def tracked(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        task = asyncio.current_task()
+        _running_jobs.add(task)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _running_jobs.discard(task)
+    return wrapper
+
+def _remove_expired_peers(service, public_keys: list, ip_addresses: dict) -> list:
+    """Bulk removal, falls back to one key at a time so one bad key does not block the rest."""
+    try:
+        service.remove_peers(public_keys, [ip_addresses[public_key] for public_key in public_keys])
+        return public_keys
+    except Exception as e:
+        logger.warning(f"Bulk removal on {service.interface} failed, retrying one by one: {e}")
+    removed = []
+    for public_key in public_keys:
+        try:
+            service.remove_peer(public_key, ip_addresses[public_key])
+            removed.append(public_key)
+        except Exception as e:
+            logger.error(f"Error removing expired peer {public_key[:10]}...: {e}")
+    return removed
+
+async def expire_shard(shard: int, rows: list) -> list:
+    """Removes expired peers of one shard and deactivates their keys. Returns the rows handled."""
+    public_keys = [row['public_key'] for row in rows]
+    await peer_restorer.discard(public_keys)
+    ip_addresses = {row['public_key']: row['ip_address'] for row in rows}
+    removed = set(await asyncio.to_thread(_remove_expired_peers, vpn_shards[shard], public_keys, ip_addresses))
+    # Keys that could not be removed stay active and are retried on the next run
+    await deactivate_keys(list(removed))
+    return [row for row in rows if row['public_key'] in removed]
+
+@tracked
+@timed(SCHEDULER_RUN_LATENCY, "check_expired_subscriptions")
 async def check_expired_subscriptions(bot):
     logger.info("Checking for expired subscriptions...")
-    expired_users = await get_expired_subs()
-    
-    for user in expired_users:
-        try:
-            public_key = user['public_key']
-            telegram_id = user['telegram_id']
-            
-            # Remove from VPN interface
-            vpn_service.remove_peer(public_key)
-            
-            # Mark as inactive in DB
-            await deactivate_key(public_key)
+    expired_keys = await get_expired_subs()
+    if not expired_keys:
+        return
+
+    # Shards are independent interfaces, process them in parallel
+    results = await asyncio.gather(*(
+        expire_shard(shard, rows) for shard, rows in group_by_shard(expired_keys).items()
+    ), return_exceptions=True)
+
+    notified = set()
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Error deactivating expired keys: {result}")
+            continue
+        for row in result:
+            telegram_id = row['telegram_id']
+            if telegram_id in notified:
+                continue
+            notified.add(telegram_id)
+            audit_log.log("subscription.expired", telegram_id, end_date=row['subscription_end_date'])
             
             # Notify user
-            try:
-                await bot.send_message(telegram_id, "Ваша подписка истекла. Доступ к VPN приостановлен. Продлите подписку, чтобы продолжить пользоваться сервисом.")
-            except:
-                pass
-                
+            await notification_sender.send(
+                bot, telegram_id,
+                "Ваша подписка истекла. Доступ к VPN приостановлен. Продлите подписку, чтобы продолжить пользоваться сервисом.",
+                kind="expired", reply_markup=renew_kb()
+            )
+
             logger.info(f"Deactivated user {telegram_id}")
-            
-        except Exception as e:
-            logger.error(f"Error deactivating user {user['telegram_id']}: {e}")
 
-def setup_scheduler(bot):
+@tracked
+@timed(SCHEDULER_RUN_LATENCY, "reconcile_peers")
+async def reconcile_peers():
+    if peer_restorer.pending or peer_restorer.in_progress:
+        logger.info("Peer restore still running, skipping reconcile")
+        return
+    try:
+        await reconcile()
+    except Exception as e:
+        logger.error(f"Scheduled reconcile failed: {e}")
+
+@tracked
+@timed(SCHEDULER_RUN_LATENCY, "expiry_reminders")
+async def expiry_reminders(bot):
+    try:
+        await send_expiry_reminders(bot)
+    except Exception as e:
+        logger.error(f"Expiry reminders failed: {e}")
+
+@tracked
+@timed(SCHEDULER_RUN_LATENCY, "backup")
+async def scheduled_backup():
+    try:
+        await backup_now()
+    except Exception as e:
+        logger.error(f"Scheduled backup failed: {e}")
+
+def add_tenant_jobs(scheduler, tenant):
+    """Jobs of one tenant, with its intervals, each run in the tenant's context."""
+    tenant_settings, bot = tenant.settings, tenant.bot
+
+    def add(fn, args=(), **interval):
+        scheduler.add_job(
+            in_tenant(fn, tenant_settings), "interval", args=list(args), name=f"{tenant.name}.{fn.__name__}", **interval
+        )
+
+    add(check_expired_subscriptions, [bot], hours=1)
+    if tenant_settings.RECONCILE_INTERVAL_MINUTES:
+        add(reconcile_peers, minutes=tenant_settings.RECONCILE_INTERVAL_MINUTES)
+    if tenant_settings.reminder_offsets and tenant_settings.REMINDER_INTERVAL_MINUTES:
+        add(expiry_reminders, [bot], minutes=tenant_settings.REMINDER_INTERVAL_MINUTES)
+    if tenant_settings.BACKUP_INTERVAL_HOURS:
+        add(scheduled_backup, hours=tenant_settings.BACKUP_INTERVAL_HOURS)
+
+def setup_scheduler(tenants: list):
+    """One scheduler for all tenants (src/tenants.py)."""
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_expired_subscriptions, "interval", hours=1, args=[bot])
+    for tenant in tenants:
+        add_tenant_jobs(scheduler, tenant)
     scheduler.start()
+    return scheduler
+
+async def shutdown_scheduler(scheduler, timeout: float):
+    """Stops new runs, lets running jobs finish (up to timeout), then shuts down."""
+    scheduler.pause()
+    if _running_jobs:
+        logger.info(f"Waiting for {len(_running_jobs)} scheduled jobs to finish...")
+        await asyncio.wait(set(_running_jobs), timeout=timeout)
+    # AsyncIOExecutor cancels whatever is still running
+    scheduler.shutdown(wait=False)
@@ -0,0 +1,130 @@
+"""
+Per-peer bandwidth shaping with tc/HTB on the awg interface.
+
+Egress of the interface is the traffic going to clients (their downloads), which is
+what saturates a shared box. Layout, one tree per interface:
+
+    1:      htb root qdisc, unclassified traffic goes to 1:1
+    1:ffff  parent class with the link rate
+    1:1     default class (server traffic, peers without a rate class)
+    1:<n>   one class per peer, n = host offset of its IPv4 address inside the subnet
+
+Peers are matched by destination address with flower filters, which the kernel keeps in
+a hash table, so classification stays O(1) with thousands of peers. All changes go
+through `tc -force -batch -`: one process per bulk update, like `awg set` for peers.
+"""
+from config import settings
+import ipaddress
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+ROOT_MINOR = 0xFFFF
+DEFAULT_MINOR = 1
+
+class Shaper:
+    def __init__(self, interface: str, subnet, rates: dict, link_rate: str, dual_stack: bool = False):
+        self.interface = interface
+        self.subnet = subnet
+        self.dual_stack = dual_stack
+        self.rates = rates
+        self.link_rate = link_rate
+
+    def rate_for(self, plan: str):
+        """tc rate of a plan (catalog payload such as sub_30), falls back to the "default" class."""
+        return self.rates.get(plan) or self.rates.get("default")
+
+    def _minor(self, ip_address: str) -> int:
+        return int(ipaddress.IPv4Address(ip_address)) - int(self.subnet.network_address)
+
+    def setup_commands(self) -> list:
+        dev = f"dev {self.interface}"
+        return [
+            f"qdisc replace {dev} root handle 1: htb default {DEFAULT_MINOR:x}",
+            f"class replace {dev} parent 1: classid 1:{ROOT_MINOR:x} htb rate {self.link_rate} ceil {self.link_rate}",
+            f"class replace {dev} parent 1:{ROOT_MINOR:x} classid 1:{DEFAULT_MINOR:x} htb rate {self.link_rate} ceil {self.link_rate}",
+        ]
+
+    def peer_commands(self, ip_address: str, ip6_address: str = None, plan: str = None) -> list:
+        rate = self.rate_for(plan)
+        if not rate:
+            # Unlimited: drop a class a previous owner of this address may have left
+            return self.clear_commands(ip_address)
+        minor = self._minor(ip_address)
+        dev = f"dev {self.interface}"
+        commands = [
+            f"class replace {dev} parent 1:{ROOT_MINOR:x} classid 1:{minor:x} htb rate {rate} ceil {rate}",
+            f"filter replace {dev} parent 1: protocol ip prio 1 handle {minor} flower dst_ip {ip_address} classid 1:{minor:x}",
+        ]
+        if ip6_address:
+            commands.append(
+                f"filter replace {dev} parent 1: protocol ipv6 prio 2 handle {minor} flower dst_ip {ip6_address} classid 1:{minor:x}"
+            )
+        return commands
+
+    def clear_commands(self, ip_address: str) -> list:
+        minor = self._minor(ip_address)
+        dev = f"dev {self.interface}"
+        commands = [f"filter del {dev} parent 1: protocol ip prio 1 handle {minor} flower"]
+        if self.dual_stack:
+            commands.append(f"filter del {dev} parent 1: protocol ipv6 prio 2 handle {minor} flower")
+        commands.append(f"class del {dev} classid 1:{minor:x}")
+        return commands
+
+    def run(self, commands: list, strict: bool = False) -> bool:
+        """
+        Applies commands in one `tc -batch` process. -force keeps going past individual
+        errors. Errors of deletes are expected (the class of a peer that never had one) and
+        only logged at debug level; strict runs (setup, adding classes) log them as warnings.
+        Shaping is best effort: failures never fail the peer operation that triggered them.
+        """
+        if not commands:
+            return True
+        try:
+            result = subprocess.run(
+                ["tc", "-force", "-batch", "-"], input="\n".join(commands) + "\n",
+                capture_output=True, text=True, timeout=settings.VPN_COMMAND_TIMEOUT
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"tc failed on {self.interface}: {e}")
+            return False
+        if result.returncode != 0:
+            log = logger.warning if strict else logger.debug
+            log(f"tc reported errors on {self.interface}: {result.stderr.strip()[:300]}")
+            return False
+        return True
+
+    def setup(self) -> bool:
+        return self.run(self.setup_commands(), strict=True)
+
+    def apply(self, peers: list) -> bool:
+        """peers: list of (ip_address, ip6_address, plan)."""
+        limited = [peer for peer in peers if self.rate_for(peer[2])]
+        unlimited = [peer[0] for peer in peers if not self.rate_for(peer[2])]
+        # Adding classes fails if the HTB root is missing, e.g. on an interface recreated since setup()
+        ok = self.run([command for peer in limited for command in self.peer_commands(*peer)], strict=True)
+        return self.clear(unlimited) and ok
+
+    def clear(self, ip_addresses: list) -> bool:
+        return self.run([command for ip in ip_addresses if ip for command in self.clear_commands(ip)])
+
+def parse_rates(spec: str) -> dict:
+    """SHAPING_RATES="sub_30=20mbit,sub_90=50mbit,sub_365=100mbit,default=20mbit" -> dict."""
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            plan, rate = item.split("=", 1)
+            rates[plan.strip()] = rate.strip()
+    return rates
+
+def create_shaper(interface: str, subnet, dual_stack: bool = False):
+    """Shaper for an interface, None if SHAPING_RATES is empty."""
+    rates = parse_rates(settings.SHAPING_RATES)
+    if not rates:
+        return None
+    if subnet.prefixlen < 16:
+        # Class minors are 16 bit
+        logger.warning(f"Subnet {subnet} of {interface} is larger than /16, bandwidth shaping disabled")
+        return None
+    return Shaper(interface, subnet, rates, settings.SHAPING_LINK_RATE, dual_stack)
@@ -0,0 +1,80 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+import aiosqlite
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in a SQLite table, survives restarts. One long-lived connection."""
+
+    def __init__(self, path: str, key_builder: DefaultKeyBuilder = None):
+        self.path = path
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._db = None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._db is None:
+            self._db = await aiosqlite.connect(self.path)
+            await self._db.execute("PRAGMA journal_mode=WAL")
+            await self._db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT
+                )
+            """)
+            await self._db.commit()
+        return self._db
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        db = await self._connection()
+        value = state.state if isinstance(state, State) else state
+        await db.execute(
+            "INSERT INTO fsm_storage (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self.key_builder.build(key), value)
+        )
+        await db.commit()
+
+    async def get_state(self, key: StorageKey):
+        db = await self._connection()
+        async with db.execute("SELECT state FROM fsm_storage WHERE key = ?", (self.key_builder.build(key),)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        db = await self._connection()
+        await db.execute(
+            "INSERT INTO fsm_storage (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (self.key_builder.build(key), json.dumps(dict(data)))
+        )
+        await db.commit()
+
+    async def get_data(self, key: StorageKey) -> dict:
+        db = await self._connection()
+        async with db.execute("SELECT data FROM fsm_storage WHERE key = ?", (self.key_builder.build(key),)) as cursor:
+            row = await cursor.fetchone()
+            return json.loads(row[0]) if row and row[0] else {}
+
+    async def close(self) -> None:
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+def create_storage(backend: str, db_path: str) -> BaseStorage:
+    """
+    FSM storage factory:
+    "sqlite" (default) - table in the bot database,
+    "memory" - aiogram MemoryStorage, lost on restart,
+    "redis://..." - aiogram RedisStorage, needs the `redis` package.
+    """
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(db_path)
+    if backend.startswith("redis://") or backend.startswith("rediss://"):
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(backend)
+    raise ValueError(f"Unknown FSM storage backend: {backend}")
@@ -0,0 +1,113 @@
+"""
+Multi-tenant mode: several white-label bots (tenants) in one process.
+
+The .env bot is the "default" tenant; TENANTS_FILE adds more. Each entry overrides any
+Settings field of the .env ones, e.g.:
+
+    [{"TENANT": "brand2", "BOT_TOKEN": "...", "PAYMENT_TOKEN": "...", "ADMIN_IDS": "42",
+      "DB_NAME": "brand2.db", "VPN_INTERFACE": "awg2", "VPN_PORT": 51822, "VPN_SUBNET": "10.20.0.0/24",
+      "PRICE_1_MONTH": 150}]
+
+Tenants share the event loop, the dispatcher, the scheduler, the metrics endpoint and
+the worker threads. Their state is separate: `settings` resolves to the current tenant
+(config.use_settings), and the singletons holding tenant state (vpn_shards, peer_restorer,
+job_queue, audit_log, the catalog, view loaders, ...) are TenantLocal, one instance per
+tenant. The current tenant is a context variable: it is set for every update by
+TenantMiddleware and for every scheduled job, and inherited by the tasks and to_thread
+calls started from there.
+"""
+from config import Settings, base_settings, settings, use_settings
+from typing import NamedTuple
+import functools
+import json
+import os
+
+class TenantLocal:
+    """
+    A module-level singleton with one instance per tenant. The instance is created by
+    factory() on first use, in the tenant's context. Attribute access, indexing, iteration
+    and len() go to the current tenant's instance.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instances", {})
+
+    def get(self):
+        name = settings.TENANT
+        instance = self._instances.get(name)
+        if instance is None:
+            instance = self._instances[name] = self._factory()
+        return instance
+
+    def instances(self) -> list:
+        """Instances of all tenants created so far, e.g. for metrics."""
+        return list(self._instances.values())
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+    def __contains__(self, item):
+        return item in self.get()
+
+class Tenant(NamedTuple):
+    settings: Settings
+    bot: object
+
+    @property
+    def name(self) -> str:
+        return self.settings.TENANT
+
+def _interfaces(tenant_settings: Settings) -> list:
+    specs = [spec for spec in tenant_settings.VPN_SHARDS.split(";") if spec.strip()]
+    return [spec.split(",")[0].strip() for spec in specs] or [tenant_settings.VPN_INTERFACE]
+
+def load_tenants(path: str = None) -> list:
+    """
+    Settings of every tenant, the default one first. Tenants must not share a bot, a
+    database or an awg interface: reconcile would remove the peers of the other tenant.
+    """
+    path = base_settings.TENANTS_FILE if path is None else path
+    tenants = [base_settings]
+    if path:
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+        defaults = base_settings.model_dump()
+        for entry in entries:
+            if not entry.get("TENANT") or not entry.get("BOT_TOKEN"):
+                raise Exception(f"{path}: every tenant needs TENANT and BOT_TOKEN")
+            # Snapshots are rotated per directory, so each tenant gets its own by default
+            entry.setdefault("BACKUP_DIR", os.path.join(base_settings.BACKUP_DIR, entry["TENANT"]))
+            tenants.append(Settings(**{**defaults, "TENANTS_FILE": "", **entry}))
+
+    for field, values in (
+        ("TENANT", [s.TENANT for s in tenants]),
+        ("BOT_TOKEN", [s.BOT_TOKEN for s in tenants]),
+        ("DB_NAME", [os.path.abspath(s.DB_NAME) for s in tenants]),
+        ("VPN interface", [interface for s in tenants for interface in _interfaces(s)]),
+    ):
+        duplicates = sorted({str(value) for value in values if values.count(value) > 1})
+        if duplicates:
+            # Never log a token
+            raise Exception(f"Tenants share a {field}" + ("" if field == "BOT_TOKEN" else f": {', '.join(duplicates)}"))
+    return tenants
+
+def in_tenant(fn, tenant_settings: Settings):
+    """fn (a coroutine function) that runs in the context of the tenant, for scheduler jobs."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with use_settings(tenant_settings):
+            return await fn(*args, **kwargs)
+    return wrapper
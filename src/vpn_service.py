@@ -1,16 +1,66 @@
+import asyncio
+import functools
+import socket
 import subprocess
 import ipaddress
 from config import settings
+from src.circuit import CircuitBreaker
+from src.shaping import create_shaper
+from src.tenants import TenantLocal
+from src.metrics import vpn_timed, CIRCUIT_OPEN
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Peers per `awg set` invocation, keeps argv well below ARG_MAX
+PEER_BATCH_SIZE = 1000
+
+def _ipv4_to_int(ip: str) -> int:
+    # Much cheaper than ipaddress.ip_address() when parsing every used address
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+def peer_addresses(peer) -> tuple:
+    """(ip_address, ip6_address) of a key row or dict, ip6_address may be missing."""
+    ip6_address = peer['ip6_address'] if 'ip6_address' in peer.keys() else None
+    return peer['ip_address'], ip6_address
+
+def peer_plan(peer):
+    """Plan (bandwidth class) of a key row joined with its user, None if unknown."""
+    return peer['plan'] if 'plan' in peer.keys() else None
+
+def peer_shard(peer) -> int:
+    """Shard of a key row or dict, keys created before sharding live on shard 0."""
+    shard = peer['shard'] if 'shard' in peer.keys() else None
+    return shard or 0
+
+def group_by_shard(peers: list) -> dict:
+    groups = {}
+    for peer in peers:
+        groups.setdefault(peer_shard(peer), []).append(peer)
+    return groups
+
+def guarded(fn):
+    """Runs a VpnService method through the service's circuit breaker."""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        return self.breaker.call(fn, self, *args, **kwargs)
+    return wrapper
+
 class VpnService:
-    def __init__(self):
-        self.interface = settings.VPN_INTERFACE
-        self.subnet = ipaddress.ip_network(settings.VPN_SUBNET)
+    def __init__(self, interface: str = None, port: int = None, subnet: str = None, subnet6: str = None):
+        self.interface = interface or settings.VPN_INTERFACE
+        self.subnet = ipaddress.ip_network(subnet or settings.VPN_SUBNET)
+        # Optional IPv6 ULA prefix for dual-stack, must hold at least as many addresses as the IPv4 subnet
+        subnet6 = settings.VPN_SUBNET_V6 if subnet6 is None else subnet6
+        self.subnet6 = ipaddress.ip_network(subnet6) if subnet6 else None
+        if self.subnet6 and self.subnet6.num_addresses < self.subnet.num_addresses:
+            raise ValueError(f"IPv6 prefix of {self.interface} is smaller than its IPv4 subnet")
         self.server_host = settings.VPN_HOST
-        self.server_port = settings.VPN_PORT
+        self.server_port = port or settings.VPN_PORT
+        self.breaker = CircuitBreaker(self.interface, settings.VPN_BREAKER_FAILURES, settings.VPN_BREAKER_RESET_SECONDS)
+        CIRCUIT_OPEN.set_function(lambda: int(self.breaker.is_open), self.interface)
+        # None unless SHAPING_RATES is set
+        self.shaper = create_shaper(self.interface, self.subnet, self.subnet6 is not None)
         
         # Obfuscation params
         self.jc = settings.AMNEZIA_JC
@@ -23,6 +73,7 @@ class VpnService:
         self.h3 = settings.AMNEZIA_H3
         self.h4 = settings.AMNEZIA_H4
 
+    @vpn_timed
     def check_awg_installed(self) -> bool:
         try:
             subprocess.run(["awg", "--version"], capture_output=True, check=True)
@@ -30,29 +81,40 @@ class VpnService:
         except (subprocess.CalledProcessError, FileNotFoundError):
             return False
 
+    @vpn_timed
     def check_interface(self) -> bool:
         try:
             # Check if interface exists
-            subprocess.run(["ip", "link", "show", self.interface], capture_output=True, check=True)
+            subprocess.run(["ip", "link", "show", self.interface], capture_output=True, check=True, timeout=settings.VPN_COMMAND_TIMEOUT)
             return True
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
             return False
 
     def _run_command(self, command: list) -> str:
         try:
             logger.debug(f"Running command: {' '.join(command)}")
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
+            result = subprocess.run(command, capture_output=True, text=True, check=True, timeout=settings.VPN_COMMAND_TIMEOUT)
             logger.debug(f"Command output: {result.stdout.strip()[:100]}")
             return result.stdout.strip()
         except subprocess.CalledProcessError as e:
             logger.error(f"Command failed: {e.cmd}. Error: {e.stderr}")
             raise Exception(f"VPN Command Error: {e.stderr}")
+        except subprocess.TimeoutExpired as e:
+            logger.error(f"Command timed out: {e.cmd}")
+            raise Exception(f"VPN Command Error: {command[0]} timed out after {e.timeout}s")
 
+    @vpn_timed
+    @guarded
     def generate_keys(self):
         private_key = self._run_command(["awg", "genkey"])
         
         proc = subprocess.Popen(["awg", "pubkey"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        pub_out, pub_err = proc.communicate(input=private_key)
+        try:
+            pub_out, pub_err = proc.communicate(input=private_key, timeout=settings.VPN_COMMAND_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise Exception("Key generation timed out")
         
         if proc.returncode != 0:
              raise Exception(f"Key generation failed: {pub_err}")
@@ -61,31 +123,66 @@ class VpnService:
 
     def get_next_ip(self, used_ips: list) -> str:
         """Finds the next available IP in the subnet."""
-        # Skip network address and gateway (usually .1)
-        hosts = list(self.subnet.hosts())
-        # Assuming .1 is the server
-        available_hosts = hosts[1:] 
-        
-        used_ips_set = set(ipaddress.ip_address(ip) for ip in used_ips)
-        
-        for ip in available_hosts:
-            if ip not in used_ips_set:
-                return str(ip)
-        raise Exception("No IP addresses available in subnet")
-
-    def add_peer(self, public_key: str, allowed_ip: str):
-        """Adds a peer to the interface."""
-        # awg set <interface> peer <pubkey> allowed-ips <ip>/32
+        return self.allocate_ips(used_ips, 1)[0]
+
+    def allocate_ips(self, used_ips: list, count: int) -> list:
+        """Finds the first `count` free IPv4 addresses without enumerating the subnet."""
+        # Skip network address and the server (.1), broadcast is not a host
+        first = int(self.subnet.network_address) + 2
+        last = int(self.subnet.broadcast_address) - 1
+        taken = sorted({n for n in (_ipv4_to_int(ip) for ip in used_ips if ip) if first <= n <= last})
+
+        # Walk the gaps between taken addresses: O(u log u) in used addresses, independent of subnet size
+        allocated = []
+        candidate = first
+        for n in taken:
+            while candidate < n and len(allocated) < count:
+                allocated.append(candidate)
+                candidate += 1
+            if len(allocated) == count:
+                break
+            candidate = n + 1
+        while len(allocated) < count and candidate <= last:
+            allocated.append(candidate)
+            candidate += 1
+
+        if len(allocated) < count:
+            raise Exception("No IP addresses available in subnet")
+        return [str(ipaddress.IPv4Address(n)) for n in allocated]
+
+    def ipv6_for(self, ip_address: str):
+        """IPv6 address paired with an IPv4 one: same host offset inside VPN_SUBNET_V6, None if IPv6 is off."""
+        if not self.subnet6:
+            return None
+        offset = int(ipaddress.ip_address(ip_address)) - int(self.subnet.network_address)
+        return str(self.subnet6.network_address + offset)
+
+    def allowed_ips(self, ip_address: str, ip6_address: str = None) -> list:
+        """allowed-ips of a peer with the given client addresses."""
+        allowed = [f"{ip_address}/32"]
+        if ip6_address:
+            allowed.append(f"{ip6_address}/128")
+        return allowed
+
+    @vpn_timed
+    @guarded
+    def add_peer(self, public_key: str, allowed_ip: str, allowed_ip6: str = None, plan: str = None):
+        """Adds a peer to the interface and puts it into the bandwidth class of its plan."""
+        # awg set <interface> peer <pubkey> allowed-ips <ip>/32[,<ip6>/128]
         cmd = [
             "awg", "set", self.interface,
             "peer", public_key,
-            "allowed-ips", f"{allowed_ip}/32"
+            "allowed-ips", ",".join(self.allowed_ips(allowed_ip, allowed_ip6))
         ]
-        logger.info(f"Adding peer: {public_key[:10]}... with IP {allowed_ip}")
+        logger.info(f"Adding peer: {public_key[:10]}... with IP {allowed_ip}" + (f", {allowed_ip6}" if allowed_ip6 else ""))
         self._run_command(cmd)
+        if self.shaper:
+            self.shaper.apply([(allowed_ip, allowed_ip6, plan)])
 
-    def remove_peer(self, public_key: str):
-        """Removes a peer from the interface."""
+    @vpn_timed
+    @guarded
+    def remove_peer(self, public_key: str, ip_address: str = None):
+        """Removes a peer from the interface, and its bandwidth class if ip_address is given."""
         cmd = [
             "awg", "set", self.interface,
             "peer", public_key,
@@ -93,30 +190,101 @@ class VpnService:
         ]
         logger.info(f"Removing peer: {public_key[:10]}...")
         self._run_command(cmd)
+        if self.shaper and ip_address:
+            self.shaper.clear([ip_address])
+
+    @vpn_timed
+    @guarded
+    def add_peers(self, peers: list):
+        """
+        Adds many peers with one `awg set` call per batch, and their bandwidth classes with
+        one `tc -batch` call. peers: list of (public_key, allowed_ip[, allowed_ip6[, plan]]).
+        """
+        for i in range(0, len(peers), PEER_BATCH_SIZE):
+            batch = [(*peer, None, None)[:4] for peer in peers[i:i + PEER_BATCH_SIZE]]
+            cmd = ["awg", "set", self.interface]
+            for public_key, allowed_ip, allowed_ip6, _ in batch:
+                cmd += ["peer", public_key, "allowed-ips", ",".join(self.allowed_ips(allowed_ip, allowed_ip6))]
+            logger.info(f"Adding {len(batch)} peers in bulk")
+            self._run_command(cmd)
+            if self.shaper:
+                self.shaper.apply([peer[1:] for peer in batch])
+
+    @vpn_timed
+    @guarded
+    def remove_peers(self, public_keys: list, ip_addresses: list = None):
+        """Removes many peers with one `awg set` call per batch, and the bandwidth classes of ip_addresses."""
+        for i in range(0, len(public_keys), PEER_BATCH_SIZE):
+            batch = public_keys[i:i + PEER_BATCH_SIZE]
+            cmd = ["awg", "set", self.interface]
+            for public_key in batch:
+                cmd += ["peer", public_key, "remove"]
+            logger.info(f"Removing {len(batch)} peers in bulk")
+            self._run_command(cmd)
+        if self.shaper and ip_addresses:
+            self.shaper.clear(ip_addresses)
 
+    def setup_shaping(self) -> bool:
+        """Installs the HTB tree on the interface, call before (re)adding peers."""
+        if not self.shaper:
+            return True
+        return self.shaper.setup()
+
+    def iter_peers(self):
+        """Streams (public_key, allowed_ips) of live peers from `awg show <iface> dump`."""
+        cmd = ["awg", "show", self.interface, "dump"]
+        logger.debug(f"Running command: {' '.join(cmd)}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        try:
+            # First line describes the interface itself
+            next(proc.stdout, None)
+            for line in proc.stdout:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 4:
+                    continue
+                allowed = fields[3]
+                yield fields[0], frozenset() if allowed == "(none)" else frozenset(allowed.split(","))
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read()
+            proc.stderr.close()
+            if proc.wait() != 0:
+                logger.error(f"Command failed: {cmd}. Error: {stderr}")
+                raise Exception(f"VPN Command Error: {stderr}")
+
+    @vpn_timed
     def restore_peers(self, peers: list):
         """Restores peers from database to the interface."""
-        # peers is a list of dicts/objects with public_key and ip_address
+        # peers is a list of dicts/Rows with public_key, ip_address and optionally ip6_address
         if not self.check_interface():
             logger.warning(f"Interface {self.interface} not found. Cannot restore peers.")
             return
 
+        self.setup_shaping()
         logger.info(f"Restoring {len(peers)} peers...")
+        for i in range(0, len(peers), PEER_BATCH_SIZE):
+            self.restore_batch(peers[i:i + PEER_BATCH_SIZE])
+
+    def restore_batch(self, peers: list):
+        """Adds a batch with one awg call, falls back to one call per peer if that fails."""
+        try:
+            self.add_peers([(peer['public_key'], *peer_addresses(peer), peer_plan(peer)) for peer in peers])
+            return
+        except Exception as e:
+            logger.warning(f"Bulk restore of {len(peers)} peers failed, retrying one by one: {e}")
+
         for peer in peers:
             try:
-                # Handle both dict and Row objects
-                public_key = peer['public_key'] if isinstance(peer, dict) else peer.public_key
-                ip_address = peer['ip_address'] if isinstance(peer, dict) else peer.ip_address
-                self.add_peer(public_key, ip_address)
+                self.add_peer(peer['public_key'], *peer_addresses(peer), peer_plan(peer))
             except Exception as e:
-                pub_key = peer['public_key'] if isinstance(peer, dict) else peer.public_key
-                logger.error(f"Failed to restore peer {pub_key}: {e}")
+                logger.error(f"Failed to restore peer {peer['public_key']}: {e}")
 
-    def generate_client_config(self, private_key: str, client_ip: str, server_pubkey: str) -> str:
+    def generate_client_config(self, private_key: str, client_ip: str, server_pubkey: str, client_ip6: str = None) -> str:
         """Generates the AmneziaWG config file content."""
+        address = f"{client_ip}/32, {client_ip6}/128" if client_ip6 else f"{client_ip}/32"
         return f"""[Interface]
 PrivateKey = {private_key}
-Address = {client_ip}/32
+Address = {address}
 DNS = {settings.VPN_DNS}
 Jc = {self.jc}
 Jmin = {self.jmin}
@@ -135,6 +303,8 @@ Endpoint = {self.server_host}:{self.server_port}
 PersistentKeepalive = 25
 """
 
+    @vpn_timed
+    @guarded
     def get_server_pubkey(self) -> str:
         """Retrieves the server's public key."""
         if not self.check_interface():
@@ -144,4 +314,141 @@ PersistentKeepalive = 25
         logger.info(f"Retrieved server public key: {pubkey[:10]}...")
         return pubkey
 
-vpn_service = VpnService()
+class ShardPool:
+    """The awg interfaces served by this bot. Shard ids are indexes into VPN_SHARDS."""
+
+    def __init__(self, services: list):
+        self.services = services
+
+    def __getitem__(self, shard) -> VpnService:
+        return self.services[shard or 0]
+
+    def __iter__(self):
+        return iter(enumerate(self.services))
+
+    def __len__(self):
+        return len(self.services)
+
+    def pick(self, telegram_id: int, loads: dict) -> int:
+        """
+        Shard for a new key. "hash" keeps all devices of a user on one shard,
+        "least_loaded" picks the shard with the most free addresses left.
+        loads: shard -> number of active keys.
+        """
+        if len(self.services) == 1:
+            return 0
+        if settings.VPN_SHARD_STRATEGY == "hash":
+            return telegram_id % len(self.services)
+        # Shards whose circuit is open are skipped while any other is up
+        available = [shard for shard, service in self if not service.breaker.is_open] or range(len(self.services))
+        return max(
+            available,
+            key=lambda shard: self.services[shard].subnet.num_addresses - loads.get(shard, 0)
+        )
+
+def load_shards() -> list:
+    """
+    VPN_SHARDS="awg1,51821,10.9.0.0/24,fd09::/64;awg2,51822,10.10.0.0/24"
+    (interface,port,subnet[,ipv6 prefix] per shard). Empty means the single
+    VPN_INTERFACE/VPN_PORT/VPN_SUBNET interface.
+    """
+    if not settings.VPN_SHARDS.strip():
+        return [VpnService()]
+    services = []
+    for spec in settings.VPN_SHARDS.split(";"):
+        if not spec.strip():
+            continue
+        fields = [field.strip() for field in spec.split(",")]
+        interface, port, subnet = fields[:3]
+        subnet6 = fields[3] if len(fields) > 3 else ""
+        services.append(VpnService(interface, int(port), subnet, subnet6))
+    return services
+
+vpn_shards = TenantLocal(lambda: ShardPool(load_shards()))
+# Shard 0, for calls that do not depend on the interface (e.g. generate_keys)
+vpn_service = TenantLocal(lambda: vpn_shards[0])
+
+class PeerRestorer:
+    """
+    Restores peers in the background after startup so polling can begin immediately.
+    Every shard is restored in parallel. Handlers only wait for the peers they touch:
+    ensure() restores queued peers right away, discard() drops peers about to be removed;
+    both wait if the peer is in a batch being applied.
+    """
+
+    def __init__(self, shards: ShardPool):
+        self.shards = shards
+        self.pending = set()
+        self.in_progress = set()
+        self.task = None
+        self._changed = asyncio.Condition()
+
+    def start(self, peers: list) -> asyncio.Task:
+        self.pending = {peer['public_key'] for peer in peers}
+        self.task = asyncio.create_task(self._run(peers))
+        return self.task
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _run(self, peers: list):
+        try:
+            groups = group_by_shard(peers)
+            logger.info(f"Restoring {len(peers)} peers on {len(groups)} shards in background...")
+            # Every shard, also those without keys: _run_shard installs the shaping tree new peers need
+            await asyncio.gather(*(self._run_shard(shard, groups.get(shard, [])) for shard, _ in self.shards))
+            logger.info("Peer restore finished")
+        finally:
+            self.pending.clear()
+            await self._notify()
+
+    async def _run_shard(self, shard: int, peers: list):
+        service = self.shards[shard]
+        try:
+            if not await asyncio.to_thread(service.check_interface):
+                logger.warning(f"Interface {service.interface} not found. Cannot restore peers.")
+                self.pending -= {peer['public_key'] for peer in peers}
+                return
+            await asyncio.to_thread(service.setup_shaping)
+            for i in range(0, len(peers), PEER_BATCH_SIZE):
+                # Skip keys restored (or removed) by a handler in the meantime
+                batch = [peer for peer in peers[i:i + PEER_BATCH_SIZE] if peer['public_key'] in self.pending]
+                if not batch:
+                    continue
+                batch_keys = {peer['public_key'] for peer in batch}
+                self.in_progress |= batch_keys
+                self.pending -= batch_keys
+                try:
+                    await asyncio.to_thread(service.restore_batch, batch)
+                finally:
+                    self.in_progress -= batch_keys
+                    await self._notify()
+        except Exception as e:
+            logger.error(f"Failed to restore peers on {service.interface}: {e}")
+
+    async def _wait_in_progress(self, wanted: set):
+        async with self._changed:
+            await self._changed.wait_for(lambda: wanted.isdisjoint(self.in_progress))
+
+    async def ensure(self, peers: list):
+        """Makes sure the given peers (key rows) are on the interface."""
+        if not self.pending and not self.in_progress:
+            return
+        queued = [peer for peer in peers if peer['public_key'] in self.pending]
+        if queued:
+            # Jump the queue instead of waiting for earlier batches
+            self.pending -= {peer['public_key'] for peer in queued}
+            for shard, shard_peers in group_by_shard(queued).items():
+                await asyncio.to_thread(self.shards[shard].restore_batch, shard_peers)
+        await self._wait_in_progress({peer['public_key'] for peer in peers})
+
+    async def discard(self, public_keys: list):
+        """Call before removing peers: drops them from the restore queue so they are not re-added."""
+        if not self.pending and not self.in_progress:
+            return
+        wanted = set(public_keys)
+        self.pending -= wanted
+        await self._wait_in_progress(wanted)
+
+peer_restorer = TenantLocal(lambda: PeerRestorer(vpn_shards.get()))